@@ -41,16 +41,342 @@ import os
 import inspect
 import traceback
 import subprocess
+import concurrent.futures
+import asyncio
+import contextlib
+import selectors
+import collections
+import collections.abc
+import shlex
+import threading
+import functools
+import hashlib
+import sqlite3
+import tempfile
+import mmap
+import array
+import bisect
+import itertools
+import codecs
+import signal
 #import glob
 import shutil
 
 
+class PatternSet:
+    """Set of regular expressions compiled once and matched against
+    lines of text. Each pattern gets a literal
+    prefilter, a substring every match must contain; lines without it
+    are rejected by the fast 'in' test before the regex runs. Patterns
+    which are plain literals do not use the regex at all. With several
+    patterns one combined scan for any of the literals rejects the lines
+    none of them can match.
+    """
+
+    # Smallest number of patterns for the combined literal scan in find_all
+    combined_prefilter_min = 8
+
+    def __init__(self, patterns):
+        if isinstance(patterns, (str, bytes, re.Pattern)):
+            patterns = [patterns]
+        self.regexes = [re.compile(pattern) for pattern in patterns]
+        self.literals = []      # prefilter per pattern, None if unknown
+        self.literal_only = []  # pattern is the literal itself
+        for regex in self.regexes:
+            (literal, literal_only) = PatternSet.required_literal(regex)
+            self.literals.append(literal)
+            self.literal_only.append(literal_only)
+        self.any_literal = None
+        if len(self.regexes) > 1 and all(self.literals) and \
+                all(isinstance(x, str) for x in self.literals):
+            self.any_literal = re.compile(
+                "|".join(re.escape(x) for x in sorted(set(self.literals), key=len)))
+        self.tests = [self.__make_test(idx) for idx in range(len(self.regexes))]
+
+    @staticmethod
+    @functools.lru_cache(maxsize=256)
+    def compile(patterns):
+        """Cached PatternSet for a pattern or a tuple of patterns"""
+        return PatternSet(patterns)
+
+    @staticmethod
+    def required_literal(regex):
+        """Longest substring any match of regex must contain:
+        (literal, literal_only). literal is None when it is unknown or
+        the pattern ignores case, literal_only is True when the pattern
+        is nothing but the literal
+        """
+        if not isinstance(regex.pattern, str) or regex.flags & re.IGNORECASE:
+            return (None, False)
+        # pylint: disable=protected-access
+        parser = getattr(re, "_parser", None)
+        if parser is None:
+            import sre_parse as parser  # pylint: disable=import-outside-toplevel
+        constants = getattr(re, "_constants", None) or parser
+        try:
+            parsed = parser.parse(regex.pattern, regex.flags)
+        except Exception:  # pylint: disable=broad-except
+            return (None, False)
+        # pylint: enable=protected-access
+        candidates = []
+
+        def __walk(items):
+            run = []
+            for (operation, argument) in items:
+                if operation == constants.LITERAL:
+                    run.append(chr(argument))
+                    continue
+                candidates.append("".join(run))
+                run = []
+                if operation == constants.SUBPATTERN:
+                    if not argument[1] & re.IGNORECASE:
+                        __walk(argument[-1])
+                elif operation in (constants.MAX_REPEAT, constants.MIN_REPEAT) \
+                        and argument[0] >= 1:
+                    __walk(argument[2])
+            candidates.append("".join(run))
+
+        items = list(parsed)
+        __walk(items)
+        literal_only = all(operation == constants.LITERAL for (operation, _) in items)
+        literal = max(candidates, key=len)
+        if literal == "" and not literal_only:
+            return (None, False)
+        return (literal, literal_only)
+
+    def __make_test(self, idx):
+        """line --> bool for pattern idx"""
+        literal = self.literals[idx]
+        search = self.regexes[idx].search
+        if self.literal_only[idx]:
+            return lambda line: literal in line
+        if literal is None:
+            return lambda line: search(line) is not None
+        return lambda line: literal in line and search(line) is not None
+
+    def match_line(self, line):
+        """Indices of patterns matching the line"""
+        if self.any_literal is not None and self.any_literal.search(line) is None:
+            return []
+        return [idx for (idx, test) in enumerate(self.tests) if test(line)]
+
+    def find_all(self, txt):
+        """Line numbers matching each pattern:
+        [[line numbers of pattern 0], [line numbers of pattern 1], ...]
+        A stream is read once; a list is scanned once by the combined
+        literal prefilter when there are enough patterns
+        """
+        if not isinstance(txt, collections.abc.Sequence):
+            # Stream (file, generator): the only pass tests every line
+            ret_val = [[] for _ in self.tests]
+            match_line = self.match_line
+            for (line_idx, line) in enumerate(txt):
+                for idx in match_line(line):
+                    ret_val[idx].append(line_idx)
+            return ret_val
+        if self.any_literal is None or len(self.tests) < self.combined_prefilter_min:
+            # 'in' scans run in C, for a few patterns they beat one
+            # combined scan with per-line dispatch
+            return [self.find(txt, idx) for idx in range(len(self.tests))]
+        # One combined scan keeps candidate lines, patterns test them only
+        any_literal = self.any_literal.search
+        candidates = [(line_idx, line) for (line_idx, line) in enumerate(txt)
+                      if any_literal(line) is not None]
+        return [[line_idx for (line_idx, line) in candidates if test(line)]
+                for test in self.tests]
+
+    def __byte_candidates(self, txt, idx, start=0):
+        """LazyText lines which may match pattern idx, None if all may"""
+        literal = self.literals[idx]
+        if not isinstance(txt, LazyText) or not isinstance(literal, str) or \
+                literal == "" or "\n" in literal or not txt.bytes_prefilter():
+            return None
+        return txt.lines_containing(literal, start)
+
+    def find(self, txt, idx=0):
+        """Line numbers matching pattern idx"""
+        test = self.tests[idx]
+        candidates = self.__byte_candidates(txt, idx)
+        if candidates is not None:
+            return [line_idx for line_idx in candidates if test(txt[line_idx])]
+        return [line_idx for (line_idx, line) in enumerate(txt) if test(line)]
+
+    def find_any(self, txt):
+        """Line numbers matching at least one pattern"""
+        match_line = self.match_line
+        return [line_idx for (line_idx, line) in enumerate(txt) if match_line(line)]
+
+    def find_not(self, txt, idx=0):
+        """Line numbers not matching pattern idx"""
+        if isinstance(txt, LazyText):
+            found = set(self.find(txt, idx))
+            return [line_idx for line_idx in range(len(txt)) if line_idx not in found]
+        test = self.tests[idx]
+        return [line_idx for (line_idx, line) in enumerate(txt) if not test(line)]
+
+    def search_forward(self, txt, start=0, idx=0):
+        """First line number >= start matching pattern idx or -1"""
+        test = self.tests[idx]
+        candidates = self.__byte_candidates(txt, idx, start)
+        if candidates is not None:
+            for line_idx in candidates:
+                if test(txt[line_idx]):
+                    return line_idx
+            return -1
+        for line_idx in range(start, len(txt)):
+            if test(txt[line_idx]):
+                return line_idx
+        return -1
+
+    def search_backward(self, txt, start=-1, idx=0):
+        """Last line number <= start matching pattern idx or -1"""
+        if start < 0:
+            start = len(txt) - 1
+        test = self.tests[idx]
+        for line_idx in range(start, -1, -1):
+            if test(txt[line_idx]):
+                return line_idx
+        return -1
+
+    def replace(self, txt, replacement, idx=0):
+        """re.sub of pattern idx in every line, lines without the
+        literal are copied as they are
+        """
+        sub = self.regexes[idx].sub
+        literal = self.literals[idx]
+        if literal is None or literal == "":
+            return [sub(replacement, line) for line in txt]
+        return [sub(replacement, line) if literal in line else line for line in txt]
+# end of class PatternSet
+
+
+class LazyText(collections.abc.Sequence):
+    """Read-only text file as a sequence of lines, backed by mmap.
+    The array('Q') of line start offsets is built on first access
+    (8 bytes per line), lines are decoded only when they are touched.
+    Supports len, indexing, slicing (list of lines), iteration and the
+    TextEditor/Shrec find and search functions. Lines end at b'\\n';
+    with clean=True they are rstripped like TextEditor.read does.
+    PatternSet searches literals in the raw bytes first, so only lines
+    which may match are decoded
+    """
+
+    chunk_size = 1 << 24
+
+    def __init__(self, file_name, encoding="UTF-8", errors="replace", clean=True):
+        self.file_name = file_name
+        self.encoding = encoding
+        self.errors = errors
+        self.clean = clean
+        self.offsets = None
+        with open(file_name, "rb") as input_file:
+            self.size = os.fstat(input_file.fileno()).st_size
+            self.data = None
+            if self.size > 0:
+                self.data = mmap.mmap(input_file.fileno(), 0, access=mmap.ACCESS_READ)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def close(self):
+        """Unmap the file"""
+        if self.data is not None:
+            self.data.close()
+            self.data = None
+
+    def line_index(self):
+        """Line start offsets, array('Q'), built on first call"""
+        if self.offsets is None:
+            offsets = array.array("Q")
+            if self.size > 0:
+                offsets.append(0)
+                for pos in range(0, self.size, self.chunk_size):
+                    parts = self.data[pos:pos + self.chunk_size].split(b"\n")
+                    # Line starts follow every b'\n' of the chunk
+                    starts = itertools.accumulate(
+                        map((1).__add__, map(len, parts[:-1])), initial=pos)
+                    next(starts)
+                    offsets.extend(starts)
+                if offsets[-1] == self.size:
+                    offsets.pop()   # no empty line after the last b'\n'
+            self.offsets = offsets
+        return self.offsets
+
+    def __len__(self):
+        return len(self.line_index())
+
+    def line_bytes(self, idx):
+        """Raw bytes of line idx without b'\\n'"""
+        offsets = self.line_index()
+        end = offsets[idx + 1] - 1 if idx + 1 < len(offsets) else self.size
+        if end > offsets[idx] and self.data[end - 1:end] == b"\n":
+            end -= 1
+        return self.data[offsets[idx]:end]
+
+    def __decode(self, idx):
+        line = self.line_bytes(idx).decode(self.encoding, self.errors)
+        if self.clean:
+            return line.rstrip()
+        if idx + 1 < len(self.offsets) or self.data[self.size - 1:] == b"\n":
+            return line.rstrip("\r") + "\n"
+        return line
+
+    def __getitem__(self, idx):
+        if isinstance(idx, slice):
+            return [self.__decode(x) for x in range(*idx.indices(len(self)))]
+        if idx < 0:
+            idx += len(self)
+        if not 0 <= idx < len(self):
+            raise IndexError("LazyText index out of range")
+        return self.__decode(idx)
+
+    def __iter__(self):
+        for idx in range(len(self)):
+            yield self.__decode(idx)
+
+    def bytes_prefilter(self):
+        """True if a literal found in a decoded line is always found
+        in its raw bytes (see lines_containing)
+        """
+        return (codecs.lookup(self.encoding).name in ("utf-8", "ascii", "latin-1",
+                                                      "iso8859-1") and
+                self.errors in ("strict", "replace", "surrogateescape"))
+
+    def lines_containing(self, literal, start=0):
+        """Ascending numbers of lines >= start whose bytes contain the
+        literal, found by mmap.find without decoding
+        """
+        offsets = self.line_index()
+        if self.data is None or start >= len(offsets):
+            return
+        needle = literal.encode(self.encoding, self.errors)
+        pos = offsets[start]
+        while True:
+            pos = self.data.find(needle, pos)
+            if pos < 0:
+                return
+            line = bisect.bisect_right(offsets, pos) - 1
+            yield line
+            if line + 1 >= len(offsets):
+                return
+            pos = offsets[line + 1]
+# end of class LazyText
+
+
 class TextEditor:
     """ Collection of text (list of strings) operations
     """
     @staticmethod
-    def read(file_name_str, clean=True):
-        """Read file to the list(str)"""
+    def read(file_name_str, clean=True, lazy=False):
+        """Read file to the list(str), with lazy=True to a LazyText"""
+        if lazy:
+            try:
+                return LazyText(file_name_str, clean=clean)
+            except (IOError, ValueError):
+                return []
         text = []
         # pylint: disable=consider-using-with
         try:
@@ -105,66 +431,157 @@ class TextEditor:
         """starting from start_idx searching forward for pattern.
         Returns index or -1 if not found
         """
-        # pylint: disable=consider-using-enumerate
-        #         indexation is used for return value
-        for idx in range(start, len(txt)):
-            matches = re.findall(pattern, txt[idx])
-            if matches:
-                return idx
-        # pylint: enable=consider-using-enumerate
-        return -1
+        return PatternSet.compile(pattern).search_forward(txt, start)
 
     @staticmethod
     def search_backward(txt, pattern, start=-1):
         """starting from start_idx searching backward for pattern.
         Returns index or -1 if not found
         """
-        if start < 0:
-            start = len(txt) - 1
-        # pylint: disable=consider-using-enumerate
-        #         indexation is used for return value
-        for idx in range(start, -1, -1):
-            matches = re.findall(pattern, txt[idx])
-            if matches:
-                return idx
-        # pylint: enable=consider-using-enumerate
-        return -1
+        return PatternSet.compile(pattern).search_backward(txt, start)
 
     @staticmethod
-    def find(txt, pattern):
-        """Returns array of line numbers matching the pattern"""
+    # pylint: disable=too-many-arguments,too-many-locals
+    def iter_lines_backward(file_name, block_size=1 << 20, encoding="UTF-8",
+                            errors="replace", clean=True, contains=b""):
+        """Yields (byte offset, line) from the end of the file to its
+        start. The file is read backwards in blocks aligned to
+        block_size, a line crossing a block boundary is joined before it
+        is yielded. With contains only lines whose bytes include it are
+        yielded, blocks without it are not split at all
+        """
+        # pylint: enable=too-many-arguments,too-many-locals
+        with open(file_name, "rb") as input_file:
+            size = os.fstat(input_file.fileno()).st_size
+            if size == 0:
+                return
+            block_pos = (size - 1) // block_size * block_size
+            end = size
+            carry = b""
+            last_piece = True   # empty piece after a final b'\n' is no line
+            while True:
+                input_file.seek(block_pos)
+                buffer = input_file.read(end - block_pos) + carry
+                # Up to the first b'\n' the line may start in the previous block
+                first_break = buffer.find(b"\n") if block_pos > 0 else -1
+                if first_break < 0 and block_pos > 0:
+                    carry = buffer
+                elif contains and contains not in buffer[first_break + 1:]:
+                    carry = buffer[:max(first_break, 0)]
+                    last_piece = False
+                else:
+                    pieces = buffer[first_break + 1:].split(b"\n")
+                    line_end = block_pos + len(buffer)
+                    for piece in reversed(pieces):
+                        line_start = line_end - len(piece)
+                        line_end = line_start - 1
+                        if last_piece:
+                            last_piece = False
+                            if piece == b"":
+                                continue
+                        if contains and contains not in piece:
+                            continue
+                        line = piece.decode(encoding, errors)
+                        yield (line_start, line.rstrip() if clean else line.rstrip("\r"))
+                    carry = buffer[:max(first_break, 0)]
+                if block_pos == 0:
+                    return
+                end = block_pos
+                block_pos -= block_size
+
+    @staticmethod
+    def search_backward_file(file_name, pattern, end=-1, block_size=1 << 20):
+        """Last line of the file matching pattern, reading from the end:
+        returns (byte offset, line) or (-1, None) if not found. With end
+        only lines starting before byte offset end are searched. Time
+        depends on the distance of the match from the end of the file
+        """
+        patterns = PatternSet.compile(pattern)
+        literal = patterns.literals[0]
+        contains = b""
+        if isinstance(literal, str) and "\n" not in literal:
+            contains = literal.encode("UTF-8")
+        test = patterns.tests[0]
+        for (offset, line) in TextEditor.iter_lines_backward(
+                file_name, block_size, contains=contains):
+            if 0 <= end <= offset:
+                continue
+            if test(line):
+                return (offset, line)
+        return (-1, None)
+
+    @staticmethod
+    def tail(file_name, count=10, offsets=False, block_size=1 << 16):
+        """Last count lines of the file, [(byte offset, line)] with
+        offsets=True. Reads only the end of the file
+        """
+        ret_val = list(itertools.islice(
+            TextEditor.iter_lines_backward(file_name, block_size), count))
+        ret_val.reverse()
+        if offsets:
+            return ret_val
+        return [line for (_, line) in ret_val]
+
+    @staticmethod
+    def grep_file(file_name, patterns, before=0, after=0):
+        """Lines of the file matching any of the patterns:
+        [(file_name, line_no, line)], with before/after context
+        [(file_name, line_no, line, context)] where context is
+        get_fragment(text, line_no - before, line_no + after).
+        line_no is the index in the text as find() returns it. The file
+        is memory-mapped (LazyText); unreadable and binary files give []
+        """
+        try:
+            text = LazyText(file_name)
+        except (IOError, ValueError):
+            return []
+        with text:
+            if text.data is not None and b"\0" in text.data[:8192]:
+                return []
+            pattern_set = PatternSet.compile(
+                patterns if isinstance(patterns, (str, bytes, re.Pattern)) else tuple(patterns))
+            found = set()
+            for idx in range(len(pattern_set.tests)):
+                found.update(pattern_set.find(text, idx))
+            ret_val = []
+            for line_no in sorted(found):
+                if before or after:
+                    ret_val.append((file_name, line_no, text[line_no], TextEditor.get_fragment(
+                        text, line_no - before, line_no + after)))
+                else:
+                    ret_val.append((file_name, line_no, text[line_no]))
+            return ret_val
+
+    @staticmethod
+    def grep_files(file_names, patterns, before=0, after=0):
+        """grep_file for a batch of files, one task of a process pool"""
         ret_val = []
-        idx = 0
-        for line in txt:
-            matches = re.findall(pattern, line)
-            if matches:
-                ret_val.append(idx)
-            idx += 1
+        for file_name in file_names:
+            ret_val.extend(TextEditor.grep_file(file_name, patterns, before, after))
         return ret_val
 
+    @staticmethod
+    def find(txt, pattern):
+        """Returns array of line numbers matching the pattern"""
+        return PatternSet.compile(pattern).find(txt)
+
+    @staticmethod
+    def find_many(txt, patterns):
+        """Returns array of line numbers for every pattern, one pass"""
+        return PatternSet.compile(tuple(patterns)).find_all(txt)
+
     @staticmethod
     def find_not(txt, pattern):
         """Returns array of line numbers not matching the pattern"""
-        ret_val = []
-        idx = 0
-        for line in txt:
-            matches = re.findall(pattern, line)
-            if matches:
-                pass
-            else:
-                ret_val.append(idx)
-            idx += 1
-        return ret_val
+        return PatternSet.compile(pattern).find_not(txt)
 
     @staticmethod
     def get_fragment(txt, start, stop):
         """cut fragment of text and return it as new text"""
-        filtered = []
         start = max(start, 0)
-        stop = min(stop, len(txt)-1)
-        for idx in range(start, (stop + 1)):
-            filtered.append(txt[idx])
-        return filtered
+        if stop < start:
+            return []
+        return list(txt[start:stop + 1])
 
     @staticmethod
     # pylint: disable=too-many-arguments
@@ -269,20 +686,71 @@ class TextEditor:
     @staticmethod
     def replace(txt, pattern, replacement):
         """replace pattern in all strings"""
-        ret_val = []
-        for line in txt:
-            cur = re.sub(pattern, replacement, line)
-            ret_val.append(cur)
-        return ret_val
+        return PatternSet.compile(pattern).replace(txt, replacement)
 
     @staticmethod
-    def remove_duplicates(txt):
-        """Remove duplicated lines"""
-        output = []
-        for cur_str in txt:
-            if cur_str not in output:
-                output.append(cur_str)
-        return output
+    def remove_duplicates(txt, key=None):
+        """Remove duplicated lines, the first occurrence is kept.
+        key(line) gives the value compared instead of the line
+        """
+        if key is None:
+            return list(dict.fromkeys(txt))
+        return list(TextEditor.iter_unique(txt, key))
+
+    @staticmethod
+    def iter_unique(lines, key=None, digest=False, spill=""):
+        """Streaming remove_duplicates: yields first occurrences of lines
+        from an iterable or from a file (name), in input order.
+        key(line) gives the value compared instead of the line.
+        digest=True keeps a 16-byte BLAKE2 digest per distinct line
+        instead of the line itself. spill (file name, or True for a
+        temporary file) keeps the digests in an SQLite table on disk,
+        for inputs whose distinct lines do not fit in memory
+        """
+        if isinstance(lines, str):
+            with open(lines, encoding="UTF-8", errors="ignore") as input_file:
+                yield from TextEditor.iter_unique(
+                    (line.rstrip("\r\n") for line in input_file), key, digest, spill)
+            return
+
+        def __digest(value):
+            return hashlib.blake2b(str(value).encode("utf-8", "surrogatepass"),
+                                   digest_size=16).digest()
+
+        if not spill:
+            seen = set()
+            for line in lines:
+                value = line if key is None else key(line)
+                if digest:
+                    value = __digest(value)
+                if value not in seen:
+                    seen.add(value)
+                    yield line
+            return
+
+        # pylint: disable=consider-using-with
+        temp_dir = None
+        if spill is True:
+            temp_dir = tempfile.TemporaryDirectory(prefix="shellbox_unique_")
+            spill = os.path.join(temp_dir.name, "seen.sqlite")
+        # pylint: enable=consider-using-with
+        database = sqlite3.connect(spill)
+        try:
+            database.execute("PRAGMA journal_mode=OFF")
+            database.execute("PRAGMA synchronous=OFF")
+            database.execute("DROP TABLE IF EXISTS seen")
+            database.execute("CREATE TABLE seen (digest BLOB PRIMARY KEY) WITHOUT ROWID")
+            insert = "INSERT OR IGNORE INTO seen VALUES (?)"
+            for (idx, line) in enumerate(lines):
+                value = line if key is None else key(line)
+                if database.execute(insert, (__digest(value),)).rowcount:
+                    yield line
+                if idx % 100000 == 99999:
+                    database.commit()
+        finally:
+            database.close()
+            if temp_dir is not None:
+                temp_dir.cleanup()
 
     @staticmethod
     def is_text(val):
@@ -296,55 +764,632 @@ class TextEditor:
         return True
 
 
-class ShellBox:
-    """Perform shell operations"""
+class RunResult(dict):
+    """Result record of run(), a dict: res["stdout"], res.get(),
+    dict(res), json.dumps(res), isinstance(res, dict).
 
-    def __init__(self):
-        pass
+    Two keys are computed on first access and then stored: "allout" is
+    joined from stdout and stderr, "stack" is formatted from the raw
+    (file, line, function) tuples captured according to stack_mode:
+        "lazy" -- formatted like traceback.format_list() on first access
+        "raw"  -- the tuples themselves are the value of "stack"
+        "none" -- no stack is captured, there is no "stack" key
+    """
+
+    __slots__ = ("frames", "stack_mode", "with_allout")
+
+    fields = (
+        "function",
+        "seconds",
+        "command",
+        "comment",
+        "status",
+        "dir",
+        "diagnostics",
+        "stdout",
+        "stderr",
+        "flags",
+        "process",
+    )
+
+    # Keys left out of to_dict() unless asked for: derived or not JSON-able
+    helpers = ("allout", "stdout_raw", "stderr_raw")
+
+    stack_modes = ("lazy", "raw", "none")
+
+    # pylint: disable=too-many-arguments
+    def __init__(self, function, command_str, comment="", stack_mode="lazy", with_allout=True):
+        # pylint: enable=too-many-arguments
+        if stack_mode not in RunResult.stack_modes:
+            raise ValueError(f"Unknown stack mode '{stack_mode}'")
+        super().__init__()
+        now = time.time()
+        self.stack_mode = stack_mode
+        self.frames = None
+        self.with_allout = with_allout
+        argv = None
+        if not isinstance(command_str, str):
+            # argv list: keep it, "command" is its shell-quoted form
+            argv = list(command_str)
+            command_str = shlex.join(command_str)
+        dict.update(
+            self,
+            function=function,
+            seconds=now,
+            command=command_str,
+            comment=comment,
+            status=-666,
+            dir=os.getcwd(),
+            diagnostics="",
+            stdout=[],
+            stderr=[],
+            flags={},
+            process={
+                "pid": -666,
+                "time": str(datetime.datetime.now()),
+                "started": now,
+                "finished": now,
+                "elapsed": -666.0,
+            },
+        )
+        if argv is not None:
+            dict.__setitem__(self, "argv", argv)
+
+    def capture_stack(self, skip=1):
+        """Remember the call stack without the innermost skip frames"""
+        if self.stack_mode == "none":
+            return
+        frames = []
+        # pylint: disable=protected-access
+        frame = sys._getframe(skip + 1)
+        # pylint: enable=protected-access
+        while frame is not None:
+            frames.append((frame.f_code.co_filename, frame.f_lineno, frame.f_code.co_name))
+            frame = frame.f_back
+        frames.reverse()
+        self.frames = frames
+
+    def __lazy_keys(self):
+        """Keys which exist but are not computed yet"""
+        keys = []
+        if self.frames is not None and not dict.__contains__(self, "stack"):
+            keys.append("stack")
+        if self.with_allout and not dict.__contains__(self, "allout"):
+            keys.append("allout")
+        return keys
+
+    def __compute(self, key):
+        """Store the value of a lazy key"""
+        if key == "stack":
+            if self.stack_mode == "raw":
+                value = self.frames
+            else:
+                summary = traceback.StackSummary.from_list(
+                    [(file_name, line, name, None) for (file_name, line, name) in self.frames]
+                )
+                value = traceback.format_list(summary)
+            self.frames = None
+            dict.__setitem__(self, "stack", value)
+            return value
+        # allout follows stdout and stderr until they are final
+        all_stdout = " ".join(dict.__getitem__(self, "stdout"))
+        all_stderr = " ".join(dict.__getitem__(self, "stderr"))
+        return (all_stdout + " " + all_stderr).strip()
+
+    def __getitem__(self, key):
+        try:
+            return dict.__getitem__(self, key)
+        except KeyError:
+            if key in self.__lazy_keys():
+                return self.__compute(key)
+            raise
+
+    def get(self, key, default=None):
+        if key in self:
+            return self[key]
+        return default
+
+    def __setitem__(self, key, value):
+        if key == "stack":
+            self.frames = None
+        dict.__setitem__(self, key, value)
+
+    def __delitem__(self, key):
+        if key in RunResult.fields:
+            raise KeyError(f"Field '{key}' of RunResult can not be removed")
+        if key == "allout":
+            self.with_allout = False
+        if key == "stack" and self.frames is not None:
+            self.frames = None
+            return
+        if dict.__contains__(self, key) or key != "allout":
+            dict.__delitem__(self, key)
+
+    def pop(self, key, *default):
+        if key in self:
+            value = self[key]
+            del self[key]
+            return value
+        if default:
+            return default[0]
+        raise KeyError(key)
+
+    def __contains__(self, key):
+        return dict.__contains__(self, key) or key in self.__lazy_keys()
+
+    def __iter__(self):
+        yield from dict.__iter__(self)
+        yield from self.__lazy_keys()
+
+    def __len__(self):
+        return dict.__len__(self) + len(self.__lazy_keys())
+
+    def keys(self):
+        return collections.abc.KeysView(self)
+
+    def items(self):
+        return collections.abc.ItemsView(self)
+
+    def values(self):
+        return collections.abc.ValuesView(self)
+
+    def __eq__(self, other):
+        if not isinstance(other, dict):
+            return NotImplemented
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        equal = self.__eq__(other)
+        return equal if equal is NotImplemented else not equal
+
+    __hash__ = None
+
+    def __repr__(self):
+        return f"RunResult({self.to_dict(helpers=True)!r})"
+
+    def __reduce__(self):
+        return (dict, (self.to_dict(helpers=True),))
+
+    def to_dict(self, helpers=False):
+        """Plain dict copy; allout and raw bytes only with helpers=True"""
+        ret_val = {}
+        for key in self:
+            if helpers or key not in RunResult.helpers:
+                ret_val[key] = self[key]
+        return ret_val
+
+    def copy(self):
+        """Plain dict copy, like dict.copy()"""
+        return self.to_dict(helpers=True)
+
+    def to_json(self, indent=None):
+        """Serialize the record the way it is written to the log"""
+        return json.dumps(self.to_dict(), indent=indent, ensure_ascii=True)
+
+    @staticmethod
+    def loggable(record):
+        """record as it is written to the log: RunResult --> to_dict()"""
+        if isinstance(record, RunResult):
+            return record.to_dict()
+        return record
+
+
+class LineStreamer:
+    """Multiplex output pipes of a child process into one stream of lines.
+
+    Pipes are polled with selectors and read without blocking, so a chatty
+    stderr can not fill up while stdout is consumed. Iteration yields
+    tuples (timestamp, stream_name, line) in arrival order and stops when
+    every pipe reached EOF. It also stops when the wall-clock timeout
+    passes or no data arrived for idle_timeout seconds, the reason is
+    left in the expired attribute ("timeout" or "idle_timeout").
+    """
+
+    chunk_size = 65536
+
+    def __init__(self, streams, timeout=None, idle_timeout=None):
+        """streams: dict stream_name -> binary pipe (e.g. process.stdout)"""
+        self.selector = selectors.DefaultSelector()
+        self.deadline = None if timeout is None else time.time() + timeout
+        self.idle_timeout = idle_timeout
+        self.expired = None
+        self.pending = {}
+        for stream_name, stream in streams.items():
+            if stream is None:
+                continue
+            os.set_blocking(stream.fileno(), False)
+            self.selector.register(stream, selectors.EVENT_READ, stream_name)
+            self.pending[stream_name] = b""
+
+    @staticmethod
+    def __decode(raw_line):
+        return raw_line.decode("utf-8", errors="replace").rstrip()
+
+    def __wait_time(self, last_activity):
+        """Seconds select() may block, None for no limit"""
+        limits = []
+        if self.deadline is not None:
+            limits.append(self.deadline)
+        if self.idle_timeout is not None:
+            limits.append(last_activity + self.idle_timeout)
+        if not limits:
+            return None
+        return max(0.0, min(limits) - time.time())
+
+    def __check_expired(self, last_activity):
+        now = time.time()
+        if self.deadline is not None and now >= self.deadline:
+            self.expired = "timeout"
+        elif self.idle_timeout is not None and now - last_activity >= self.idle_timeout:
+            self.expired = "idle_timeout"
+        return self.expired is not None
+
+    def __iter__(self):
+        last_activity = time.time()
+        try:
+            while self.selector.get_map():
+                events = self.selector.select(self.__wait_time(last_activity))
+                if not events and self.__check_expired(last_activity):
+                    return
+                for (key, _) in events:
+                    stream_name = key.data
+                    chunk = os.read(key.fd, LineStreamer.chunk_size)
+                    timestamp = time.time()
+                    last_activity = timestamp
+                    if not chunk:
+                        # EOF: flush the last unterminated line
+                        self.selector.unregister(key.fileobj)
+                        line = LineStreamer.__decode(self.pending.pop(stream_name))
+                        if line != "":
+                            yield (timestamp, stream_name, line)
+                        continue
+                    parts = re.split(b"[\r\n]", self.pending[stream_name] + chunk)
+                    self.pending[stream_name] = parts.pop()
+                    for raw_line in parts:
+                        line = LineStreamer.__decode(raw_line)
+                        if line != "":
+                            yield (timestamp, stream_name, line)
+        finally:
+            self.close()
+
+    def close(self):
+        """Stop watching the pipes, pipes themselves stay open"""
+        for key in list(self.selector.get_map().values()):
+            self.selector.unregister(key.fileobj)
+        self.selector.close()
+
+
+class AccountedPopen(subprocess.Popen):
+    """Popen reaping its child with os.wait4(), which also returns the
+    resource usage of the child and of every descendant it waited for.
+    The usage is kept in the rusage attribute once the child is reaped.
+    Only the public poll() and wait() are redefined: once returncode is
+    set, Popen itself never waits for the child again.
+    Note maxrss_kb is never below the RSS of the spawning Python process:
+    the child shares its memory until exec.
+    """
+
+    rusage = None
+
+    def __init__(self, *args, **kwargs):
+        self.__reap_lock = threading.Lock()
+        super().__init__(*args, **kwargs)
+
+    def __reap(self, wait_flags):
+        """Collect the child with os.wait4, True once it is reaped"""
+        with self.__reap_lock:
+            if self.returncode is not None:
+                return True
+            try:
+                (done_pid, status, rusage) = os.wait4(self.pid, wait_flags)
+            except ChildProcessError:
+                # Same as Popen: the child is gone and its status is lost
+                self.returncode = 0
+                return True
+            if done_pid != self.pid:
+                return False
+            self.rusage = rusage
+            self.returncode = os.waitstatus_to_exitcode(status)
+            return True
+
+    def poll(self):
+        """Popen.poll() accounting the resources of the child"""
+        self.__reap(os.WNOHANG)
+        return self.returncode
+
+    def wait(self, timeout=None):
+        """Popen.wait() accounting the resources of the child"""
+        if timeout is None:
+            while not self.__reap(0):
+                pass
+            return self.returncode
+        deadline = time.monotonic() + timeout
+        delay = 0.0005
+        while not self.__reap(os.WNOHANG):
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise subprocess.TimeoutExpired(self.args, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.05)
+        return self.returncode
 
     @staticmethod
-    # pylint: disable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements, consider-using-with
+    def usage_to_dict(rusage):
+        """Fields of resource.struct_rusage stored in run results"""
+        return {
+            "user": rusage.ru_utime,
+            "system": rusage.ru_stime,
+            "maxrss_kb": rusage.ru_maxrss,
+            "minflt": rusage.ru_minflt,
+            "majflt": rusage.ru_majflt,
+            "nvcsw": rusage.ru_nvcsw,
+            "nivcsw": rusage.ru_nivcsw,
+            "inblock": rusage.ru_inblock,
+            "oublock": rusage.ru_oublock,
+        }
+
+
+class CapturePolicy:
+    """What run() keeps of the child output, parsed from capture= argument
+
+    "full"        -- all lines (default)
+    "tail:N"      -- only the last N lines of each stream
+    "file:PATH"   -- child writes stdout and stderr directly to PATH
+                     (appending), output never passes through Python
+    "discard"     -- output is not kept
+    "raw"         -- undecoded bytes in stdout_raw/stderr_raw, decode
+                     them with ShellBox.decode_output() when needed
+    """
+
+    modes = ("full", "tail", "file", "discard", "raw")
+
+    def __init__(self, capture=None):
+        if capture is None:
+            capture = "full"
+        (mode, _, arg) = str(capture).partition(":")
+        if mode not in CapturePolicy.modes:
+            raise ValueError(f"Unknown capture policy '{capture}'")
+        self.mode = mode
+        self.limit = None
+        self.path = None
+        if mode == "tail":
+            if not arg.isdigit() or int(arg) < 1:
+                raise ValueError(f"Capture policy '{capture}' needs a positive line count")
+            self.limit = int(arg)
+        elif mode == "file":
+            if arg == "":
+                raise ValueError(f"Capture policy '{capture}' needs a file name")
+            self.path = os.path.abspath(os.path.expanduser(arg))
+
+    def __str__(self):
+        if self.mode == "tail":
+            return f"tail:{self.limit}"
+        if self.mode == "file":
+            return f"file:{self.path}"
+        return self.mode
+
+    def new_buffer(self):
+        """Container collecting lines of one stream"""
+        if self.mode == "tail":
+            return collections.deque(maxlen=self.limit)
+        return []
+
+    def keeps_lines(self):
+        """True if decoded lines are stored in the result"""
+        return self.mode in ("full", "tail")
+
+
+class ShellSession:
+    """Long-lived bash coprocess running commands one after another.
+
+    Saves the fork/exec of a new shell per command and keeps the shell
+    state (cwd, variables, functions) between commands. Every command is
+    followed by sentinel lines on stdout and stderr, the stdout sentinel
+    carries exit status and current directory of the shell.
+
+        with ShellSession() as session:
+            session.run("cd /tmp")
+            res = session.run("test -f foo.txt", bypass_error=True)
+    """
+
+    def __init__(self, shell="/bin/bash", working_directory=""):
+        self.shell = shell
+        self.cwd = os.path.abspath(working_directory) if working_directory else os.getcwd()
+        self.process = None
+        self.sentinel = f"__SHELLSESSION_{TextEditor.randomstr(16)}__"
+        self.lock = threading.Lock()
+        self.count = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, exc_traceback):
+        self.close()
+
+    def start(self):
+        """Start the shell, done implicitly by the first command"""
+        # pylint: disable=consider-using-with
+        self.process = subprocess.Popen(
+            [self.shell, "--noprofile", "--norc"],
+            cwd=self.cwd,
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+        )
+        # pylint: enable=consider-using-with
+
+    def is_alive(self):
+        """True if the shell process is running"""
+        return self.process is not None and self.process.poll() is None
+
+    def close(self):
+        """Stop the shell"""
+        if self.process is None:
+            return
+        if self.process.poll() is None:
+            try:
+                self.process.stdin.write(b"exit 0\n")
+                self.process.stdin.close()
+            except BrokenPipeError:
+                pass
+            try:
+                self.process.wait(timeout=5)
+            except subprocess.TimeoutExpired:
+                self.process.kill()
+                self.process.wait()
+        self.process.stdout.close()
+        self.process.stderr.close()
+        self.process = None
+
+    def frame(self, command_str, working_directory=""):
+        """Shell text executing command_str followed by the sentinels"""
+        self.count += 1
+        command = f"eval {shlex.quote(command_str)} </dev/null; __shs_rc=$?"
+        if working_directory:
+            command = (
+                f"__shs_prev=$PWD; cd -- {shlex.quote(working_directory)} && {command}"
+                f'; cd -- "$__shs_prev"'
+            )
+        return (
+            f"{command}\n"
+            f"printf '\\n%s %d %d %s\\n' {self.sentinel} {self.count} $__shs_rc \"$PWD\"\n"
+            f"printf '\\n%s %d\\n' {self.sentinel} {self.count} >&2\n"
+        ).encode("utf-8")
+
+    # pylint: disable=too-many-arguments, too-many-branches
+    def execute(
+        self,
+        retval,
+        command_str,
+        quiet=False,
+        on_stdout=None,
+        on_stderr=None,
+        capture=None,
+        working_directory="",
+    ):
+        """Run command in the session and collect its output and exit
+        status into retval, counterpart of ShellBox.execute()"""
+        # pylint: enable=too-many-arguments
+        if not isinstance(command_str, str):
+            command_str = shlex.join(command_str)
+        policy = CapturePolicy(capture)
+        if policy.mode not in ("full", "tail", "discard"):
+            raise ValueError(f"Capture policy '{policy}' is not supported by ShellSession")
+
+        with self.lock:
+            if not self.is_alive():
+                self.start()
+            retval["process"]["pid"] = self.process.pid
+            if not working_directory:
+                retval["dir"] = self.cwd
+
+            self.process.stdin.write(self.frame(command_str, working_directory))
+            self.process.stdin.flush()
+
+            marker = f"{self.sentinel} {self.count}"
+            callbacks = {"stdout": on_stdout, "stderr": on_stderr}
+            consoles = {"stdout": sys.stdout, "stderr": sys.stderr}
+            buffers = {"stdout": policy.new_buffer(), "stderr": policy.new_buffer()}
+            framed = {"stdout": False, "stderr": False}
+            streamer = LineStreamer({"stdout": self.process.stdout, "stderr": self.process.stderr})
+            for (timestamp, stream_name, line) in streamer:
+                if line.startswith(marker):
+                    framed[stream_name] = True
+                    if stream_name == "stdout":
+                        (_, _, status, cwd) = line.split(" ", 3)
+                        retval["status"] = int(status)
+                        self.cwd = cwd
+                    if framed["stdout"] and framed["stderr"]:
+                        break
+                    continue
+                if not quiet:
+                    print(f"{line}", file=consoles[stream_name])
+                if policy.keeps_lines():
+                    buffers[stream_name].append(line)
+                if callbacks[stream_name] is not None:
+                    callbacks[stream_name](line, timestamp)
+
+            if not framed["stdout"]:
+                # The command ended the shell itself (e.g. "exit 3")
+                retval["status"] = self.process.wait()
+                retval["diagnostics"] = "Shell session terminated"
+                self.close()
+
+        retval["stdout"] = list(buffers["stdout"])
+        retval["stderr"] = list(buffers["stderr"])
+        return retval
+    # pylint: enable=too-many-branches
+
+    # pylint: disable=too-many-arguments
     def run(
+        self,
         command_str,
         working_directory="",
         comment="",
         quiet=None,
         bypass_error=None,
-        terminate_pattern=None
+        on_stdout=None,
+        on_stderr=None,
+        capture=None,
     ):
-        """Run Shell command"""
-        def __parse_shell_output(shell_output_str):
-            """Parse string received from process to list of
-            strings AKA text"""
-            ret_val = []
-            parsed = re.split("[\r\n]+", shell_output_str)
-            for line in parsed:
-                line = line.rstrip()
-                if line != "":
-                    ret_val.append(line)
-            return ret_val
+        """Run shell command in the session, result is the same as
+        returned by ShellBox.run()"""
+        # pylint: enable=too-many-arguments
+        retval = ShellBox.create_run_record(
+            inspect.currentframe().f_code.co_name, command_str, comment, quiet, bypass_error
+        )
+        retval["capture"] = str(CapturePolicy(capture))
+        retval["session"] = self.sentinel
+
+        if not command_str:
+            retval["diagnostics"] = "Command line is empty"
+            retval["status"] = 0
+            return retval
+
+        if working_directory:
+            retval["dir"] = os.path.abspath(working_directory)
+
+        self.execute(
+            retval,
+            command_str,
+            retval["flags"]["quiet"],
+            on_stdout,
+            on_stderr,
+            capture,
+            working_directory and retval["dir"],
+        )
+        return ShellBox.complete_run_record(retval)
+
+
+class ShellBox:
+    """Perform shell operations"""
+
+    # How run() records the call stack, see RunResult
+    stack_mode = "lazy"
+
+    def __init__(self):
+        pass
 
-        retval = {}
-        retval["function"] = inspect.currentframe().f_code.co_name
-        retval["seconds"] = time.time()
-        retval["command"] = command_str
-        retval["comment"] = comment
-        retval["status"] = -666
-        retval["dir"] = os.getcwd()
-        retval["diagnostics"] = ""
-        retval["stdout"] = []
-        retval["stderr"] = []
-        retval["flags"] = {}
-        retval["process"] = {}
-        retval["process"]["pid"] = -666
-        retval["process"]["time"] = str(datetime.datetime.now())
-        retval["process"]["started"] = time.time()
-        retval["process"]["finished"] = retval["process"]["started"]
-        retval["process"]["elapsed"] = -666.0
-
-        stack = traceback.format_list(traceback.extract_stack())
-        del stack[len(stack) - 1]
-        retval["stack"] = stack
+    @staticmethod
+    def parse_shell_output(shell_output_str):
+        """Parse string received from process to list of
+        strings AKA text"""
+        ret_val = []
+        parsed = re.split("[\r\n]+", shell_output_str)
+        for line in parsed:
+            line = line.rstrip()
+            if line != "":
+                ret_val.append(line)
+        return ret_val
+
+    @staticmethod
+    # pylint: disable=too-many-arguments
+    def create_run_record(function, command_str, comment="", quiet=None, bypass_error=None):
+        """Create the result structure shared by run() and arun()"""
+        # pylint: enable=too-many-arguments
+        retval = RunResult(function, command_str, comment, ShellBox.stack_mode)
+        # Drop this frame and the frame of run()/arun() itself
+        retval.capture_stack(skip=2)
 
         if quiet is None:
             quiet = False
@@ -353,88 +1398,760 @@ class ShellBox:
         if bypass_error is None:
             bypass_error = False
         retval["flags"]["bypass_error"] = bypass_error
+        return retval
+
+    @staticmethod
+    def complete_run_record(retval):
+        """Set timing; exit on error unless bypassed"""
+        retval["process"]["finished"] = time.time()
+        retval["process"]["elapsed"] = (
+            retval["process"]["finished"] - retval["process"]["started"]
+        )
+
+        if not retval["flags"]["bypass_error"] and (retval["status"] != 0):
+            print(retval.to_json(indent=4))
+            sys.exit(retval["status"])
+        return retval
 
-        retval["command"] = command_str
-        retval["comment"] = comment
+    @staticmethod
+    # pylint: disable=too-many-arguments, too-many-locals, consider-using-with, redefined-builtin
+    def run(
+        command_str,
+        working_directory="",
+        comment="",
+        quiet=None,
+        bypass_error=None,
+        terminate_pattern=None,
+        on_stdout=None,
+        on_stderr=None,
+        capture=None,
+        session=None,
+        timeout=None,
+        idle_timeout=None,
+        kill_grace=5.0,
+        input=None,
+    ):
+        """Run Shell command, a string for /bin/sh or an argv list executed
+        without the shell
+
+        on_stdout/on_stderr are called as callback(line, timestamp) for
+        every line as soon as it is received from the child.
+        capture selects what is kept of the output, see CapturePolicy.
+        timeout/idle_timeout (seconds) and terminate_pattern stop the
+        command with its whole process group: SIGTERM, then SIGKILL after
+        kill_grace seconds, see execute(). Only timeout works with the
+        "file" and "raw" capture policies, callbacks not with "raw".
+        input feeds stdin of the command: bytes, file name, descriptor or
+        iterator of chunks, see open_input().
+        With a ShellSession the command runs in its shell, no new process
+        is started (terminate_pattern, timeouts and input are not
+        supported there).
+        """
+        retval = ShellBox.create_run_record(
+            inspect.currentframe().f_code.co_name, command_str, comment, quiet, bypass_error
+        )
+        quiet = retval["flags"]["quiet"]
+        retval["capture"] = str(CapturePolicy(capture))
 
-        if command_str == "":
+        if not command_str:
             retval["diagnostics"] = "Command line is empty"
             retval["status"] = 0
             return retval
 
-        actual_directory = os.getcwd()
+        # The directory is handed to the child instead of os.chdir(), so
+        # the process-wide cwd is left alone and run() is safe in threads
         if working_directory:
-            os.chdir(working_directory)
-        retval["dir"] = os.getcwd()
+            retval["dir"] = os.path.abspath(working_directory)
+
+        if session is not None:
+            if any(arg is not None for arg in (terminate_pattern, timeout, idle_timeout, input)):
+                raise ValueError(
+                    "terminate_pattern, timeouts and input are not supported in a ShellSession"
+                )
+            session.execute(
+                retval,
+                command_str,
+                quiet,
+                on_stdout,
+                on_stderr,
+                capture,
+                working_directory and retval["dir"],
+            )
+        else:
+            ShellBox.execute(
+                retval,
+                command_str,
+                quiet,
+                terminate_pattern,
+                on_stdout,
+                on_stderr,
+                capture,
+                timeout,
+                idle_timeout,
+                kill_grace,
+                input,
+            )
+        return ShellBox.complete_run_record(retval)
+    # pylint: enable=too-many-arguments, too-many-locals, consider-using-with, redefined-builtin
 
-        process = subprocess.Popen(
-            command_str, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE
+    @staticmethod
+    # pylint: disable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+    # pylint: disable=consider-using-with
+    def execute(
+        retval,
+        command_str,
+        quiet=False,
+        terminate_pattern=None,
+        on_stdout=None,
+        on_stderr=None,
+        capture=None,
+        timeout=None,
+        idle_timeout=None,
+        kill_grace=5.0,
+        input_source=None,
+    ):
+        """Start command in retval["dir"] and collect its output, exit
+        status and resource usage (retval["process"]["resources"], see
+        AccountedPopen) into retval. This is the process part of run().
+
+        A command string runs through /bin/sh, an argv list is executed
+        directly (vfork/posix_spawn in subprocess), without the shell.
+
+        timeout limits the total run time, idle_timeout the time without
+        any output. A command hitting a limit or terminate_pattern is
+        stopped with SIGTERM, escalated to SIGKILL after kill_grace
+        seconds, see ShellBox.stop_process().
+
+        input_source is sent to the child stdin, see ShellBox.open_input().
+        Data is written from a thread while the output is being read, so
+        neither side can block the other. An exception raised by an input
+        iterator is re-raised here once the command has finished.
+
+        Output captured to a file or as raw bytes is not read line by line,
+        terminate_pattern and idle_timeout are rejected with ValueError, and
+        so are callbacks with raw bytes. Raw output is echoed when the
+        command ends.
+        """
+        policy = CapturePolicy(capture)
+        if policy.mode in ("file", "raw") and (
+            terminate_pattern is not None or idle_timeout is not None
+        ):
+            raise ValueError(
+                f"terminate_pattern and idle_timeout are not supported with capture '{policy}'"
+            )
+        if policy.mode == "raw" and (on_stdout is not None or on_stderr is not None):
+            raise ValueError("on_stdout and on_stderr are not supported with capture 'raw'")
+        # The tail buffer is filled while reading, not after communicate()
+        streaming = (
+            not quiet
+            or on_stdout is not None
+            or on_stderr is not None
+            or policy.mode == "tail"
+            or idle_timeout is not None
+            or terminate_pattern is not None
         )
 
+        # A command that may be stopped gets a session of its own, so the
+        # whole tree under the shell can be signalled. Other commands keep
+        # the controlling terminal for password prompts and alike.
+        isolated = timeout is not None or idle_timeout is not None or terminate_pattern is not None
+
+        sink = None
+        child_output = subprocess.PIPE
+        if policy.mode == "file":
+            sink = open(policy.path, "ab")
+            child_output = sink
+        elif policy.mode == "discard" and not streaming:
+            child_output = subprocess.DEVNULL
+
+        (child_input, chunks, owned_fd) = ShellBox.open_input(input_source, retval)
+        try:
+            process = AccountedPopen(
+                command_str,
+                shell=isinstance(command_str, str),
+                cwd=retval["dir"],
+                stdin=child_input,
+                stdout=child_output,
+                stderr=child_output,
+                start_new_session=isolated,
+            )
+        except OSError as error:
+            if chunks is not None:
+                os.close(owned_fd)
+            # Missing working directory and alike are errors of the caller
+            if isinstance(command_str, str) or error.filename != command_str[0]:
+                raise
+            # argv program can not be started: report it like the shell does
+            retval["status"] = 127 if isinstance(error, FileNotFoundError) else 126
+            retval["stderr"] = [f"{command_str[0]}: {error.strerror}"]
+            retval["diagnostics"] = str(error)
+            return retval
+        finally:
+            # The child holds its own copies of the descriptors
+            if sink is not None:
+                sink.close()
+            if owned_fd is not None:
+                os.close(child_input)
         retval["process"]["pid"] = process.pid
 
-        if quiet:
-            (raw_output, raw_error) = process.communicate()
-            retval["stdout"] = __parse_shell_output(raw_output.decode("utf-8"))
-            retval["stderr"] = __parse_shell_output(raw_error.decode("utf-8"))
-            retval["status"] = process.returncode
-        else:
-            retval["stdout"] = []
-            empty_count = 0
-            empty_count_threshold = 10
-            for line in iter(process.stdout.readline, ""):
-                line = (line.decode("utf-8")).rstrip()
-                if line == "":
-                    empty_count += 1
+        feeder = None
+        if chunks is not None:
+            feeder = threading.Thread(
+                target=ShellBox.feed_input, args=(owned_fd, chunks, retval["input"])
+            )
+            feeder.daemon = True
+            feeder.start()
+
+        reason = None
+        try:
+            if child_output is not subprocess.PIPE:
+                try:
+                    process.wait(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    reason = "timeout"
+                    ShellBox.stop_process(process, retval, reason, isolated, kill_grace)
+            elif policy.mode == "raw" or not streaming:
+                try:
+                    (raw_output, raw_error) = process.communicate(timeout=timeout)
+                except subprocess.TimeoutExpired:
+                    reason = "timeout"
+                    ShellBox.stop_process(process, retval, reason, isolated, kill_grace)
+                    (raw_output, raw_error) = process.communicate()
+                if policy.mode == "raw":
+                    (retval["stdout_raw"], retval["stderr_raw"]) = (raw_output, raw_error)
+                    if not quiet:
+                        sys.stdout.write(raw_output.decode("utf-8", errors="replace"))
+                        sys.stderr.write(raw_error.decode("utf-8", errors="replace"))
                 else:
-                    empty_count = 0
-                    print(f"{line}")
-                    retval["stdout"].append(line)
+                    retval["stdout"] = ShellBox.parse_shell_output(raw_output.decode("utf-8"))
+                    retval["stderr"] = ShellBox.parse_shell_output(raw_error.decode("utf-8"))
+            else:
+                callbacks = {"stdout": on_stdout, "stderr": on_stderr}
+                consoles = {"stdout": sys.stdout, "stderr": sys.stderr}
+                buffers = {"stdout": policy.new_buffer(), "stderr": policy.new_buffer()}
+                streamer = LineStreamer(
+                    {"stdout": process.stdout, "stderr": process.stderr}, timeout, idle_timeout
+                )
+                for (timestamp, stream_name, line) in streamer:
+                    if not quiet:
+                        print(f"{line}", file=consoles[stream_name])
+                    if policy.keeps_lines():
+                        buffers[stream_name].append(line)
+                    if callbacks[stream_name] is not None:
+                        callbacks[stream_name](line, timestamp)
+
+                    if terminate_pattern is not None and stream_name == "stdout":
+                        matches = re.findall(terminate_pattern, line)
+                        if matches:
+                            reason = "terminate_pattern"
+                            break
+                if streamer.expired is not None:
+                    reason = streamer.expired
+                if reason is not None:
+                    ShellBox.stop_process(process, retval, reason, isolated, kill_grace)
+
+                process.stdout.close()
+                process.stderr.close()
+                retval["stdout"] = list(buffers["stdout"])
+                retval["stderr"] = list(buffers["stderr"])
+        except BaseException:
+            # KeyboardInterrupt and alike must not leave the command running
+            if process.poll() is None:
+                ShellBox.stop_process(process, retval, "interrupted", isolated, kill_grace)
+            raise
+        retval["status"] = process.wait()
+        if feeder is not None:
+            feeder.join()
+            # The command saw a truncated input, its status is meaningless
+            if "exception" in retval["input"]:
+                raise retval["input"].pop("exception")
+        if process.rusage is not None:
+            retval["process"]["resources"] = AccountedPopen.usage_to_dict(process.rusage)
+        return retval
+    # pylint: enable=too-many-arguments, too-many-locals, too-many-branches, too-many-statements
+    # pylint: enable=consider-using-with
+
+    @staticmethod
+    def open_input(input_source, retval):
+        """Prepare stdin of a child. input_source may be:
+            None                    -- stdin is inherited
+            bytes                   -- data to send
+            str or path-like        -- file name, the file itself is stdin
+            int or object.fileno()  -- descriptor passed to the child as is
+            iterable                -- chunks (bytes or str) sent one by one
+        Returns (stdin for Popen, chunks to feed or None, descriptor opened
+        here or None). Files and descriptors are never copied by Python.
+        retval["input"] records the source.
+        """
+        if input_source is None:
+            return (None, None, None)
+        if isinstance(input_source, (bytes, bytearray, memoryview)):
+            retval["input"] = {"source": "bytes", "written": 0}
+            (read_fd, write_fd) = os.pipe()
+            return (read_fd, [bytes(input_source)], write_fd)
+        if isinstance(input_source, (str, os.PathLike)):
+            file_name = os.path.abspath(os.fspath(input_source))
+            retval["input"] = {"source": f"file:{file_name}"}
+            read_fd = os.open(file_name, os.O_RDONLY)
+            return (read_fd, None, read_fd)
+        if isinstance(input_source, int) or hasattr(input_source, "fileno"):
+            read_fd = input_source if isinstance(input_source, int) else input_source.fileno()
+            retval["input"] = {"source": f"fd:{read_fd}"}
+            return (read_fd, None, None)
+        retval["input"] = {"source": "iterator", "written": 0}
+        (read_fd, write_fd) = os.pipe()
+        return (read_fd, iter(input_source), write_fd)
+
+    @staticmethod
+    def feed_input(write_fd, chunks, report):
+        """Write chunks to the child stdin and close it. Writes block while
+        the pipe is full, which throttles the producer of the chunks. A
+        child closing its stdin early ends the feeding quietly. An error of
+        the chunks iterator is kept in report["exception"] for the caller."""
+        try:
+            with open(write_fd, "wb", buffering=0) as stdin:
+                for chunk in chunks:
+                    if isinstance(chunk, str):
+                        chunk = chunk.encode("utf-8")
+                    stdin.write(chunk)
+                    report["written"] += len(chunk)
+        except BrokenPipeError:
+            report["diagnostics"] = "Command closed its input"
+        except Exception as error:  # pylint: disable=broad-except
+            report["diagnostics"] = f"Input failed: {error!r}"
+            report["exception"] = error
+
+    @staticmethod
+    def process_group_alive(pgid):
+        """True if the process group has a member that is not a zombie.
+        Orphaned zombies wait for PID 1 to reap them, which may never come
+        in a container, so they do not count. Without /proc any member
+        counts."""
+        if not os.path.isdir("/proc/self"):
+            try:
+                os.killpg(pgid, 0)
+            except ProcessLookupError:
+                return False
+            except PermissionError:
+                pass
+            return True
+        for entry in os.listdir("/proc"):
+            if not entry.isdigit():
+                continue
+            try:
+                with open(f"/proc/{entry}/stat", "rb") as stat_file:
+                    stat = stat_file.read()
+            except OSError:
+                continue
+            # pid (comm) state ppid pgrp ..., comm may contain anything
+            fields = stat[stat.rfind(b")") + 2 :].split()
+            if len(fields) > 2 and int(fields[2]) == pgid and fields[0] != b"Z":
+                return True
+        return False
+
+    @staticmethod
+    def stop_process(process, retval, reason, group=True, kill_grace=5.0):
+        """Stop the command: SIGTERM, then SIGKILL if the process (or any
+        process of its group when group=True) is still alive after
+        kill_grace seconds. Records reason, signal and teardown time in
+        retval["termination"]."""
+
+        def __signal(signal_number):
+            try:
+                if group:
+                    os.killpg(process.pid, signal_number)
+                else:
+                    process.send_signal(signal_number)
+            except ProcessLookupError:
+                pass
+
+        def __alive():
+            if process.poll() is None:
+                return True
+            if not group:
+                return False
+            return ShellBox.process_group_alive(process.pid)
+
+        started = time.time()
+        used_signal = "SIGTERM"
+        __signal(signal.SIGTERM)
+        while __alive():
+            if time.time() - started >= kill_grace:
+                used_signal = "SIGKILL"
+                __signal(signal.SIGKILL)
+                break
+            time.sleep(0.02)
+        process.wait()
+
+        retval["termination"] = {
+            "reason": reason,
+            "signal": used_signal,
+            "teardown": time.time() - started,
+        }
+        retval["diagnostics"] = f"Terminated ({reason}) with {used_signal}"
+
+    @staticmethod
+    def decode_output(raw_output):
+        """Decode bytes captured with capture="raw" into text"""
+        return ShellBox.parse_shell_output(raw_output.decode("utf-8", errors="replace"))
+
+    @staticmethod
+    async def alines(command, working_directory="", retval=None, kill_grace=5.0):
+        """Async iterator over output of a command. Yields tuples
+        (stream, line), where stream is "stdout" or "stderr", in the
+        order the lines arrive. Command is a shell string or an argv list.
+        When retval is given, its pid and status are filled in. Leaving
+        the loop early terminates the process group of the command: SIGTERM,
+        then SIGKILL after kill_grace seconds.
+        """
+        cwd = os.path.abspath(working_directory) if working_directory else None
+        # Own process group: grandchildren holding the pipes are stopped too
+        pipes = {
+            "cwd": cwd,
+            "stdout": asyncio.subprocess.PIPE,
+            "stderr": asyncio.subprocess.PIPE,
+            "start_new_session": True,
+        }
+        if isinstance(command, str):
+            process = await asyncio.create_subprocess_shell(command, **pipes)
+        else:
+            process = await asyncio.create_subprocess_exec(*command, **pipes)
+        if retval is not None:
+            retval["process"]["pid"] = process.pid
+
+        queue = asyncio.Queue(maxsize=1024)
+
+        def __signal(signal_number):
+            try:
+                os.killpg(process.pid, signal_number)
+            except ProcessLookupError:
+                pass
 
-                if terminate_pattern is not None:
-                    matches = re.findall(terminate_pattern, line)
-                    if matches:
-                        process.terminate()
+        async def __pump(stream_name, stream):
+            # Chunks are split here: StreamReader lines are limited to 64 KiB
+            pending = b""
+            cancelled = False
+            try:
+                while True:
+                    chunk = await stream.read(1 << 16)
+                    if not chunk:
                         break
+                    raw_lines = (pending + chunk).split(b"\n")
+                    pending = raw_lines.pop()
+                    for raw_line in raw_lines:
+                        await queue.put((stream_name, raw_line.decode("utf-8", "replace").rstrip()))
+                if pending:
+                    await queue.put((stream_name, pending.decode("utf-8", "replace").rstrip()))
+            except asyncio.CancelledError:
+                cancelled = True
+                raise
+            finally:
+                # The consumer waits for the end marker of every stream
+                if not cancelled:
+                    await queue.put((stream_name, None))
+
+        pumps = [
+            asyncio.ensure_future(__pump("stdout", process.stdout)),
+            asyncio.ensure_future(__pump("stderr", process.stderr)),
+        ]
+        try:
+            open_streams = 2
+            while open_streams > 0:
+                (stream_name, line) = await queue.get()
+                if line is None:
+                    open_streams -= 1
+                elif line != "":
+                    yield stream_name, line
+        finally:
+            if process.returncode is None and open_streams > 0:
+                __signal(signal.SIGTERM)
+            for pump in pumps:
+                pump.cancel()
+            await asyncio.gather(*pumps, return_exceptions=True)
+            # Unread output pauses the pipe transports, the exit is not
+            # reported until they reach EOF
+            if open_streams > 0:
+                drain = asyncio.gather(process.stdout.read(), process.stderr.read())
+                try:
+                    await asyncio.wait_for(asyncio.shield(drain), kill_grace)
+                except asyncio.TimeoutError:
+                    __signal(signal.SIGKILL)
+                    await drain
+            status = await process.wait()
+            if retval is not None:
+                retval["status"] = status
 
-                if empty_count > empty_count_threshold:
-                    break
+    @staticmethod
+    # pylint: disable=too-many-arguments
+    async def arun(
+        command_str,
+        working_directory="",
+        comment="",
+        quiet=None,
+        bypass_error=None,
+        terminate_pattern=None
+    ):
+        """Coroutine version of run(), does not block the event loop.
+        Command may also be an argv list, executed without the shell.
+        """
+        # pylint: enable=too-many-arguments
+        retval = ShellBox.create_run_record(
+            inspect.currentframe().f_code.co_name, command_str, comment, quiet, bypass_error
+        )
+        quiet = retval["flags"]["quiet"]
 
-            raw_error_list = process.stderr.readlines()
-            retval["stderr"] = []
-            for errline in raw_error_list:
-                line = errline.decode("utf-8")
-                line = line.rstrip()
-                if line != "":
-                    retval["stderr"].append(line)
-            process.stdout.close()
-            process.stderr.close()
-            retval["status"] = process.wait()
+        if not command_str:
+            retval["diagnostics"] = "Command line is empty"
+            retval["status"] = 0
+            return retval
 
         if working_directory:
-            os.chdir(actual_directory)
+            retval["dir"] = os.path.abspath(working_directory)
 
-        retval["process"]["finished"] = time.time()
-        retval["process"]["elapsed"] = (
-            retval["process"]["finished"] - retval["process"]["started"]
-        )
+        async with contextlib.aclosing(
+            ShellBox.alines(command_str, retval["dir"], retval)
+        ) as lines:
+            async for (stream_name, line) in lines:
+                if not quiet:
+                    print(f"{line}")
+                retval[stream_name].append(line)
+                if terminate_pattern is not None and stream_name == "stdout":
+                    if re.search(terminate_pattern, line):
+                        break
 
-        # Allout is a helper and not need to be added to the log
-        all_stdout = " ".join(retval["stdout"])
-        all_stderr = " ".join(retval["stderr"])
-        retval["allout"] = (all_stdout + " " + all_stderr).strip()
+        return ShellBox.complete_run_record(retval)
 
-        if not bypass_error and (retval["status"] != 0):
-            print(json.dumps(retval, indent=4, ensure_ascii=True))
-            sys.exit(retval["status"])
+    @staticmethod
+    # pylint: disable=too-many-arguments
+    def run_many(
+        commands,
+        max_workers=None,
+        working_directory="",
+        comment="",
+        quiet=None,
+        bypass_error=None,
+        fail_fast=False,
+    ):
+        """Run a list of shell commands concurrently, at most max_workers
+        at a time. Returns the list of run() results in input order.
+
+        With fail_fast=True the commands that have not started yet are
+        skipped after the first failure; otherwise all commands are run.
+        """
+        # pylint: enable=too-many-arguments
+        # Iterated twice below, a generator would be exhausted
+        commands = list(commands)
+
+        if quiet is None:
+            quiet = False
+
+        if bypass_error is None:
+            bypass_error = False
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        # Workers check it before they start the next command
+        failure = threading.Event()
+
+        def __attempt(command_str):
+            if fail_fast and failure.is_set():
+                return None
+            res = ShellBox.run(command_str, working_directory, comment, quiet=quiet, bypass_error=True)
+            if res["status"] != 0:
+                failure.set()
+            return res
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max_workers) as pool:
+            results = list(pool.map(__attempt, commands))
+
+        failed = None
+        for idx, command_str in enumerate(commands):
+            if results[idx] is None:
+                results[idx] = RunResult("run_many", command_str, comment, stack_mode="none")
+                if working_directory:
+                    results[idx]["dir"] = os.path.abspath(working_directory)
+                results[idx]["diagnostics"] = "Skipped after failure (fail_fast)"
+            elif failed is None and results[idx]["status"] != 0:
+                failed = results[idx]
+
+        if not bypass_error and failed is not None:
+            print(failed.to_json(indent=4))
+            sys.exit(failed["status"])
+        return results
+
+    run_parallel = run_many
+
+    @staticmethod
+    def stage_title(stage):
+        """Printable form of a pipeline stage"""
+        if isinstance(stage, str):
+            return stage
+        if callable(stage):
+            return f"<python:{getattr(stage, '__name__', type(stage).__name__)}>"
+        return shlex.join(stage)
+
+    @staticmethod
+    # pylint: disable=too-many-locals, too-many-statements, consider-using-with
+    def execute_pipeline(retval, stages, quiet=False, pipefail=False, on_stdout=None, on_stderr=None):
+        """Run stages connected stdout to stdin with OS pipes and collect
+        output of the last stage, stderr of all stages and per-stage
+        status, timing and resources into retval["stages"].
+
+        A stage is a shell command string, an argv list or a callable
+        func(stdin, stdout) working on binary files and returning the exit
+        status (None means 0). Data between two process stages goes
+        through a kernel pipe and never enters Python. The status is the
+        status of the last stage or, with pipefail, the last non-zero one.
+        """
+        retval["stages"] = []
+        (err_read, err_write) = os.pipe()
+        stdin_fd = None
+        workers = []
+        for stage in stages:
+            (out_read, out_write) = os.pipe()
+            report = {
+                "command": ShellBox.stage_title(stage),
+                "pid": -666,
+                "status": -666,
+                "started": time.time(),
+                "finished": -666.0,
+                "elapsed": -666.0,
+            }
+            retval["stages"].append(report)
+
+            if callable(stage):
+                # The thread outlives err_write of the parent: own copy
+                worker = threading.Thread(
+                    target=ShellBox.__pipeline_callable,
+                    args=(stage, report, stdin_fd, out_write, os.dup(err_write)),
+                )
+                worker.start()
+            else:
+                try:
+                    process = AccountedPopen(
+                        stage,
+                        shell=isinstance(stage, str),
+                        cwd=retval["dir"],
+                        stdin=stdin_fd,
+                        stdout=out_write,
+                        stderr=err_write,
+                    )
+                except OSError as error:
+                    process = None
+                    report["status"] = 127 if isinstance(error, FileNotFoundError) else 126
+                    report["diagnostics"] = str(error)
+                    report["finished"] = time.time()
+                    report["elapsed"] = report["finished"] - report["started"]
+                finally:
+                    os.close(out_write)
+                    if stdin_fd is not None:
+                        os.close(stdin_fd)
+                worker = threading.Thread(target=ShellBox.__pipeline_wait, args=(process, report))
+                worker.start()
+            workers.append(worker)
+            stdin_fd = out_read
+        os.close(err_write)
+
+        callbacks = {"stdout": on_stdout, "stderr": on_stderr}
+        consoles = {"stdout": sys.stdout, "stderr": sys.stderr}
+        # stdin_fd is now the read end of the last stage output
+        with open(stdin_fd, "rb", buffering=0) as out_file, open(err_read, "rb", buffering=0) as err_file:
+            streamer = LineStreamer({"stdout": out_file, "stderr": err_file})
+            for (timestamp, stream_name, line) in streamer:
+                if not quiet:
+                    print(f"{line}", file=consoles[stream_name])
+                retval[stream_name].append(line)
+                if callbacks[stream_name] is not None:
+                    callbacks[stream_name](line, timestamp)
+        for worker in workers:
+            worker.join()
+
+        retval["process"]["pid"] = retval["stages"][0]["pid"]
+        retval["status"] = retval["stages"][-1]["status"]
+        if pipefail:
+            for report in retval["stages"]:
+                if report["status"] != 0:
+                    retval["status"] = report["status"]
         return retval
-    # pylint: enable=too-many-arguments, too-many-locals, too-many-branches,
-    # pylint: enable=too-many-statements, consider-using-with
+    # pylint: enable=too-many-locals, too-many-statements, consider-using-with
+
+    @staticmethod
+    def __pipeline_wait(process, report):
+        """Pipeline helper: reap a process stage and time it"""
+        if process is None:
+            return
+        report["pid"] = process.pid
+        report["status"] = process.wait()
+        report["finished"] = time.time()
+        report["elapsed"] = report["finished"] - report["started"]
+        if process.rusage is not None:
+            report["resources"] = AccountedPopen.usage_to_dict(process.rusage)
+
+    @staticmethod
+    # pylint: disable=too-many-arguments, broad-except
+    def __pipeline_callable(func, report, stdin_fd, stdout_fd, stderr_fd):
+        """Pipeline helper: run a Python stage in a thread, stderr_fd is
+        the stage's own descriptor and is closed here
+        """
+        report["pid"] = os.getpid()
+        if stdin_fd is None:
+            stdin_fd = os.open(os.devnull, os.O_RDONLY)
+        with open(stderr_fd, "wb", buffering=0) as stderr, \
+                open(stdin_fd, "rb") as stdin, open(stdout_fd, "wb") as stdout:
+            try:
+                status = func(stdin, stdout)
+                report["status"] = 0 if status is None else status
+            except BrokenPipeError:
+                report["status"] = -signal.SIGPIPE
+            except Exception as error:
+                report["status"] = 1
+                report["diagnostics"] = str(error)
+                stderr.write(f"{report['command']}: {error}\n".encode("utf-8"))
+            finally:
+                try:
+                    stdout.flush()
+                except BrokenPipeError:
+                    pass
+        report["finished"] = time.time()
+        report["elapsed"] = report["finished"] - report["started"]
+    # pylint: enable=too-many-arguments, broad-except
+
+    @staticmethod
+    # pylint: disable=too-many-arguments
+    def pipeline(
+        stages,
+        working_directory="",
+        comment="",
+        quiet=None,
+        bypass_error=None,
+        pipefail=False,
+    ):
+        """Run producer | filter | consumer chain, see execute_pipeline().
+        Returns one result record for the whole chain, run()-compatible,
+        with per-stage reports in "stages"."""
+        # pylint: enable=too-many-arguments
+        command_str = " | ".join(ShellBox.stage_title(stage) for stage in stages)
+        retval = ShellBox.create_run_record(
+            inspect.currentframe().f_code.co_name, command_str, comment, quiet, bypass_error
+        )
+        if not stages:
+            retval["diagnostics"] = "Pipeline is empty"
+            retval["status"] = 0
+            return retval
+
+        if working_directory:
+            retval["dir"] = os.path.abspath(working_directory)
+
+        ShellBox.execute_pipeline(retval, stages, retval["flags"]["quiet"], pipefail)
+        return ShellBox.complete_run_record(retval)
 
     @staticmethod
     def find_files(path, mask='*.*'):
         """ Recursively find files """
-        res = ShellBox.run(f"find {path} -iname '{mask}'", quiet=True)
+        # The path is not passed through the shell, expand ~ and $VARS here
+        path = os.path.expandvars(os.path.expanduser(path))
+        res = ShellBox.run(["find", path, "-iname", mask], quiet=True)
         return res['stdout']
 
     @staticmethod
@@ -525,7 +2242,9 @@ class LinuxAdmin:
 
     @staticmethod
     def sudo_run(command_str, working_directory="", quiet=True):
-        res = ShellBox.run(f'sshpass -f ~/.local/sudopwd.txt sudo "{command_str}"', working_directory, quiet)
+        password_file = os.path.expanduser("~/.local/sudopwd.txt")
+        argv = ["sshpass", "-f", password_file, "sudo", "sh", "-c", command_str]
+        res = ShellBox.run(argv, working_directory, quiet=quiet)
         return res['stdout']
 
 
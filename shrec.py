@@ -89,12 +89,47 @@ import pprint
 import binascii
 import importlib
 import types
-import subprocess
+import threading
+import concurrent.futures
+import contextlib
+import contextvars
+import hashlib
+import gzip
+import lzma
+import zlib
+import glob
+import queue
+import shutil
+import bisect
+import shellbox
 
 
 class Shrec(object):
     description = "todo: Update me"
 
+    # Options of the LogWriter behind the log file (see LogWriter)
+    log_writer_options = {'flush_interval': 1.0, 'batch_size': 100,
+                          'fsync': 'never', 'background': True}
+
+    # Retention of in-memory log_records (see RecordStore), unbounded
+    # by default. Example: {'max_records': 10000, 'spill': 'spill.jsonl.gz'}
+    log_retention = {}
+
+    # Rotation of the log file (see LogWriter): new segment after max_bytes
+    # or max_seconds, closed segments compressed ('gz', 'xz' or '') and
+    # only the last 'keep' of them retained. Disabled by default.
+    # Example: {'max_bytes': 64 << 20, 'compress': 'xz', 'keep': 20}
+    log_rotation = {}
+
+    # Log levels of log() and of run records, only log() is filtered by
+    # log_level
+    log_levels = {'debug': 10, 'info': 20, 'warn': 30, 'error': 40}
+
+    # Metrics of run() commands (see Metrics): written to the textfile at
+    # exit and/or served on http://127.0.0.1:port/metrics
+    metrics_textfile = ''
+    metrics_port = None
+
     ###########################################################################
     # Python-native interface to the object
     ###########################################################################
@@ -102,8 +137,13 @@ class Shrec(object):
     def __init__(self, arg_list=None):
         """ Initialization """
         # Log files
-        self.log_records = []
+        self.log_records = RecordStore(**self.log_retention)
         self.shell_script = []
+        # Serializes log_records, log file and shell_script updates
+        self.log_lock = threading.RLock()
+        self.__stage = contextvars.ContextVar('shrec_stage')
+        self.__main_stage = ''
+        self.log_writer = None
 
         self.parser = None
         if arg_list != None:
@@ -113,19 +153,33 @@ class Shrec(object):
             self.validate_parameters()  # method shall be redefined in child class
             self.logname = self.args['logname']
             if self.logname != '':
-                atexit.register(self.__close_log)
                 self.__open_log()
+                # Registered after the writer: atexit runs it first
+                atexit.register(self.__close_log)
         else:
             self.args = {}
             self.logname = ''
             self.args['quiet'] = False
             self.args['debug'] = False
 
+        # log() messages below the level are not built, --debug logs them
+        # all. Run records are always logged, --quiet only mutes the console
+        self.log_level = 'info'
+        if self.args['debug']:
+            self.log_level = 'debug'
 
         # Run parameters
         self.stage = ''
         self.bypass_error = False
         self.add_allout = True
+        self.stack_mode = 'lazy'  # 'lazy', 'raw' or 'none', see RunResult
+        self.session = None     # shellbox.ShellSession used by run()
+        self.run_cache = None   # RunCache used by run_cached()
+        self.metrics = Metrics()
+        if self.metrics_textfile:
+            atexit.register(self.metrics.write_textfile, self.metrics_textfile)
+        if self.metrics_port is not None:
+            self.metrics.serve(self.metrics_port)
 
         self.shell_script.append('#!/bin/bash')
         self.shell_script.append('#########################################')
@@ -134,6 +188,32 @@ class Shrec(object):
         self.shell_script.append('')
     # __init__
 
+    @property
+    def stage(self):
+        """ Current recipe stage, kept per thread and per asyncio task.
+            A thread which did not set its own stage sees the stage of
+            the main thread
+        """
+        return self.__stage.get(self.__main_stage)
+
+    @stage.setter
+    def stage(self, value):
+        self.__stage.set(value)
+        if threading.current_thread() is threading.main_thread():
+            self.__main_stage = value
+
+    @property
+    def log_level(self):
+        """ Threshold of log(): 'debug', 'info', 'warn' or 'error' """
+        return self.__log_level
+
+    @log_level.setter
+    def log_level(self, value):
+        if value not in self.log_levels:
+            raise ValueError('Unknown log level %s' % value)
+        self.__log_level = value
+        self.log_threshold = self.log_levels[value]
+
     def __enter__(self):
         """ Entry point for 'with sh as Shrec(args)' """
         return self
@@ -225,40 +305,283 @@ class Shrec(object):
     # Logging infrastructure
     ###########################################################################
 
-    def __open_log(self):
+    def __open_log(self, append=False):
+        """ Start the log file writer, the log is JSON Lines: one compact
+            record per line (see LogWriter, read_log)
+        """
         if self.logname != '':
-            log_record = self.__create_log_struct()
-            log_record['time'] = str(datetime.datetime.now())
-            log_record['message'] = 'Open log file'
-            with open(self.logname, "w") as log_file:
-                log_file.write("[%s\n" % json.dumps(log_record))
+            options = dict(self.log_writer_options)
+            options.update(self.log_rotation)
+            self.log_writer = LogWriter(self.logname, append=append,
+                                        segment_header=self.__segment_header,
+                                        **options)
+            if not append:
+                log_record = self.__create_log_struct()
+                log_record['time'] = str(datetime.datetime.now())
+                log_record['message'] = 'Open log file'
+                self.log_writer.write(log_record)
+
+    def __segment_header(self, previous_segment):
+        """ First record of a segment after log rotation """
+        log_record = collections.OrderedDict()
+        log_record['function'] = inspect.currentframe().f_code.co_name
+        log_record['seconds'] = time.time()
+        log_record['time'] = str(datetime.datetime.now())
+        log_record['message'] = 'Continue log file'
+        log_record['previous_segment'] = previous_segment
+        return log_record
 
     def __close_log(self):
-        if self.logname != '':
+        if (self.logname != '' and self.log_writer is not None and
+                not self.log_writer.closed):
             log_record = {}
             log_record['function'] = inspect.currentframe().f_code.co_name
             log_record['seconds'] = time.time()
             log_record['time'] = str(datetime.datetime.now())
             log_record['message'] = 'All done'
+            log_record['resources'] = self.resource_summary()
 
-            with open(self.logname, "a") as log_file:
-                log_file.write("%s]\n" % json.dumps(log_record))
+            self.log_writer.write(log_record)
+            self.log_writer.close()
+            self.log_writer = None
 
             # if len(self.shell_script) > 4:
             #     scrpit_name = self.logname.replace('.log', '.sh')
             #     self.save_file(self.shell_script, scrpit_name)
 
     def __raw_log(self, log_record):
-        self.log_records.append(log_record)
-        if self.logname:
-            with open(self.logname, "a") as log_file:
-                log_file.write("%s,\n" % json.dumps(log_record,
-                                                    indent=4,
-                                                    ensure_ascii=True))
-
-    def log(self, msg):
-        """ """
+        with self.log_lock:
+            self.log_records.append(log_record)
+            if self.logname:
+                if self.log_writer is None:
+                    # logname was assigned after __init__
+                    self.__open_log(append=True)
+                    atexit.register(self.__close_log)
+                self.log_writer.write(log_record)
+
+    def log_memory_stats(self):
+        """ Size of the in-memory log_records and of the spilled part """
+        with self.log_lock:
+            return self.log_records.stats()
+
+    def flush_log(self):
+        """ Write buffered log records to the log file now """
+        if self.log_writer is not None:
+            self.log_writer.flush()
+
+    @staticmethod
+    def log_segments(file_name):
+        """ Rotated segments of a log file, oldest first, followed by the
+            active file itself (see LogWriter)
+        """
+        segments = LogWriter.list_segments(file_name)
+        if os.path.exists(file_name):
+            segments.append(file_name)
+        return segments
+
+    @staticmethod
+    def iter_log(file_name, segments=False):
+        """ Iterate over records of a log file. Reads JSON Lines logs and
+            logs in the older '[{...},\n{...}]' format, gzip/xz-compressed
+            files, tolerates a last record cut by a crash. With segments=True
+            the rotated segments are read first (see log_segments)
+        """
+        if segments:
+            for segment in Shrec.log_segments(file_name):
+                yield from Shrec.iter_log(segment)
+            return
+        with LogWriter.open_segment(file_name) as log_file:
+            head = log_file.read(1)
+            while head.isspace():
+                head = log_file.read(1)
+            if head != '[':
+                # JSON Lines: one record per line
+                pending = head
+                for line in log_file:
+                    line = pending + line
+                    pending = ''
+                    if line.strip() == '':
+                        continue
+                    try:
+                        yield json.loads(line)
+                    except ValueError:
+                        pass
+                return
+            content = log_file.read()
+        decoder = json.JSONDecoder()
+        pos = 0
+        while True:
+            while pos < len(content) and content[pos] in ' \t\r\n,]':
+                pos += 1
+            if pos >= len(content):
+                return
+            try:
+                (record, pos) = decoder.raw_decode(content, pos)
+            except ValueError:
+                return
+            yield record
+
+    @staticmethod
+    def read_log(file_name, segments=False):
+        """ Load all records of a log file, see iter_log() """
+        return list(Shrec.iter_log(file_name, segments))
+
+    def resource_summary(self, top=10):
+        """ Resource usage of commands in log_records: totals per stage
+            and the top consumers of CPU time and memory
+        """
+        stages = collections.OrderedDict()
+        consumers = []
+        for record in self.log_records.iter_all():
+            if 'process' not in record:
+                continue
+            usage = record['process'].get('resources')
+            if usage is None:
+                continue
+            stage = record.get('stage', '')
+            if stage not in stages:
+                stages[stage] = {'commands': 0, 'elapsed': 0.0, 'user': 0.0,
+                                 'system': 0.0, 'maxrss_kb': 0,
+                                 'inblock': 0, 'oublock': 0}
+            totals = stages[stage]
+            totals['commands'] += 1
+            totals['elapsed'] += record['process']['elapsed']
+            totals['user'] += usage['user']
+            totals['system'] += usage['system']
+            totals['maxrss_kb'] = max(totals['maxrss_kb'], usage['maxrss_kb'])
+            totals['inblock'] += usage['inblock']
+            totals['oublock'] += usage['oublock']
+            consumers.append({'command': record['command'],
+                              'stage': stage,
+                              'elapsed': record['process']['elapsed'],
+                              'cpu': usage['user'] + usage['system'],
+                              'maxrss_kb': usage['maxrss_kb']})
+
+        summary = collections.OrderedDict()
+        summary['stages'] = stages
+        summary['top_cpu'] = sorted(consumers, key=lambda x: x['cpu'],
+                                    reverse=True)[:top]
+        summary['top_rss'] = sorted(consumers, key=lambda x: x['maxrss_kb'],
+                                    reverse=True)[:top]
+        return summary
+
+    @staticmethod
+    def __allocate_lanes(intervals):
+        """ Greedy interval coloring: [(start, end, item)] --> [(lane, item)]
+            Overlapping intervals never share a lane
+        """
+        lanes_end = []
+        ret_val = []
+        for (start, end, item) in sorted(intervals, key=lambda x: (x[0], -x[1])):
+            for (lane, lane_end) in enumerate(lanes_end):
+                if lane_end <= start:
+                    break
+            else:
+                lane = len(lanes_end)
+                lanes_end.append(end)
+            lanes_end[lane] = end
+            ret_val.append((lane, item))
+        return ret_val
+
+    @staticmethod
+    def trace_events(records):
+        """ Chrome Trace Event / Perfetto JSON for log records: every stage
+            is a span on a 'stage' track, every command a slice on a
+            'commands' track; parallel work gets additional tracks.
+            Log messages are instant events
+        """
+        commands = []
+        messages = []
+        for record in records:
+            process = record.get('process')
+            if isinstance(process, dict) and process.get('elapsed', -666.0) >= 0:
+                commands.append((process['started'], process['finished'], record))
+            elif 'message' in record and record.get('seconds') is not None:
+                messages.append(record)
+        origin = min([x[0] for x in commands] + [x['seconds'] for x in messages] or [0.0])
+
+        def __us(seconds):
+            return round((seconds - origin) * 1e6, 3)
+
+        stages = collections.OrderedDict()
+        for (started, finished, record) in commands:
+            stage = record.get('stage') or ''
+            span = stages.setdefault(stage, [started, finished, 0, 0])
+            span[0] = min(span[0], started)
+            span[1] = max(span[1], finished)
+            span[2] += 1
+            span[3] += record.get('status', 0) != 0
+
+        pid = 1
+        events = [{'name': 'process_name', 'ph': 'M', 'pid': pid,
+                   'args': {'name': 'shrec recipe'}}]
+        tracks = {}
+
+        def __track(kind, lane):
+            """ tid of the lane, stage tracks first """
+            key = (kind, lane)
+            if key not in tracks:
+                tid = (0 if kind == 'stage' else 1000) + lane
+                tracks[key] = tid
+                events.append({'name': 'thread_name', 'ph': 'M', 'pid': pid, 'tid': tid,
+                               'args': {'name': '%s %d' % (kind, lane)}})
+                events.append({'name': 'thread_sort_index', 'ph': 'M', 'pid': pid,
+                               'tid': tid, 'args': {'sort_index': tid}})
+            return tracks[key]
+
+        spans = [(span[0], span[1], stage) for (stage, span) in stages.items()]
+        for (lane, stage) in Shrec.__allocate_lanes(spans):
+            (started, finished, number, failed) = stages[stage]
+            events.append({'name': stage or '(no stage)', 'cat': 'stage', 'ph': 'X',
+                           'pid': pid, 'tid': __track('stage', lane),
+                           'ts': __us(started), 'dur': round((finished - started) * 1e6, 3),
+                           'args': {'commands': number, 'failed': failed}})
+        for (lane, record) in Shrec.__allocate_lanes(commands):
+            process = record['process']
+            args = {'command': record.get('command'), 'stage': record.get('stage'),
+                    'status': record.get('status'), 'pid': process.get('pid'),
+                    'dir': record.get('dir')}
+            if process.get('resources') is not None:
+                args['resources'] = process['resources']
+            if record.get('termination') is not None:
+                args['termination'] = record['termination']
+            events.append({'name': str(record.get('command'))[:80], 'cat': 'command',
+                           'ph': 'X', 'pid': pid, 'tid': __track('commands', lane),
+                           'ts': __us(process['started']),
+                           'dur': round(process['elapsed'] * 1e6, 3), 'args': args})
+        for record in messages:
+            events.append({'name': str(record['message'])[:80], 'cat': 'log', 'ph': 'i',
+                           's': 'p', 'pid': pid, 'ts': __us(record['seconds']),
+                           'args': {'message': record['message'],
+                                    'level': record.get('level'),
+                                    'stage': record.get('stage')}})
+        return {'traceEvents': events, 'displayTimeUnit': 'ms',
+                'otherData': {'origin': origin,
+                              'origin_time': str(datetime.datetime.fromtimestamp(origin))}}
+
+    def export_trace(self, file_name, log_file=''):
+        """ Save trace_events() of log_records, or of the log file with its
+            rotated segments, to file_name. Open it in chrome://tracing or
+            https://ui.perfetto.dev
+        """
+        if log_file:
+            records = self.iter_log(log_file, segments=True)
+        else:
+            records = self.log_records.iter_all()
+        trace = self.trace_events(records)
+        with open(file_name, 'w') as trace_file:
+            json.dump(trace, trace_file)
+        return trace
+
+    def log(self, msg, level='info'):
+        """ Log message with level 'debug', 'info', 'warn' or 'error'.
+            Below log_level the call returns before any record, frame
+            lookup or stack formatting
+        """
+        if self.log_levels[level] < self.log_threshold:
+            return
         log_record = self.__create_log_struct()
+        log_record['level'] = level
         log_record['message'] = msg
         log_record['stage'] = self.stage
         log_record['time'] = str(datetime.datetime.now())
@@ -285,8 +608,16 @@ class Shrec(object):
     # File operations: read, write, append
     ###########################################################################
 
-    def read_file(self, file_name_str, clean=True):
-        """  Read file to the list(str) """
+    def read_file(self, file_name_str, clean=True, lazy=False):
+        """  Read file to the list(str), with lazy=True to a LazyText
+             (memory-mapped, lines decoded on access, see shellbox)
+        """
+        if lazy:
+            try:
+                return shellbox.LazyText(file_name_str, encoding='ascii',
+                                         errors='ignore', clean=clean)
+            except (IOError, ValueError):
+                return None
         text = []
         try:
             input_file = open(file_name_str, encoding='ascii', errors='ignore')
@@ -356,22 +687,61 @@ class Shrec(object):
                     matches.append(fname)
         return sorted(matches)
 
+    # pylint: disable=too-many-arguments
+    def grep_tree(self, root, masks, patterns, workers=None, before=0,
+                  after=0, ordered=True, recursive=True, batch_size=16):
+        """ find_files(masks, root) searched for patterns by a pool of
+            worker processes. Yields (path, line_no, line), or with
+            before/after context (path, line_no, line, context), see
+            shellbox.TextEditor.grep_file. ordered=True keeps the file
+            order of find_files, otherwise results come as soon as a
+            batch of batch_size files is searched. workers=1 searches
+            in this process
+        """
+        # pylint: enable=too-many-arguments
+        if not isinstance(masks, list):
+            masks = [masks]
+        if not isinstance(patterns, (str, re.Pattern)):
+            patterns = tuple(patterns)
+        # Overlapping masks find the same file more than once
+        file_names = list(dict.fromkeys(self.find_files(masks, root, recursive)))
+        batches = [file_names[idx:idx + batch_size]
+                   for idx in range(0, len(file_names), batch_size)]
+        if workers is None:
+            workers = os.cpu_count() or 1
+        if workers <= 1:
+            for batch in batches:
+                yield from shellbox.TextEditor.grep_files(batch, patterns, before, after)
+            return
+        with concurrent.futures.ProcessPoolExecutor(workers) as pool:
+            futures = [pool.submit(shellbox.TextEditor.grep_files, batch,
+                                   patterns, before, after) for batch in batches]
+            try:
+                completed = futures
+                if not ordered:
+                    completed = concurrent.futures.as_completed(futures)
+                for future in completed:
+                    yield from future.result()
+            finally:
+                # The caller stopped early: do not search the rest
+                for future in futures:
+                    future.cancel()
+
+    @staticmethod
     def git_root(starting_point=''):
-        start_dir = os.getcwd()
-        if starting_point:
-            os.chdir(starting_point)
+        """ Nearest directory holding .git at or above starting_point
+            (current directory by default), '' if there is none.
+            Process cwd is not changed, so it is safe in threads
+        """
+        cur_dir = os.path.realpath(starting_point or os.getcwd())
         while True:
-            cur_dir = os.getcwd()
-            if os.path.exists('.git'):
-                git_root = os.getcwd()
-                os.chdir(start_dir)
-                return git_root
-            os.chdir('..')
-            new_dir = os.getcwd()
+            if os.path.exists(os.path.join(cur_dir, '.git')):
+                return cur_dir
+            new_dir = os.path.dirname(cur_dir)
             if new_dir == cur_dir:
                 # Device top level directory. Stop search, no .git found
-                os.chdir(start_dir)
                 return ''
+            cur_dir = new_dir
     # git_root
 
     def current_platform(self):
@@ -428,67 +798,50 @@ class Shrec(object):
         """ starting from start_idx searching forward for pattern.
             Returns index or -1 if not found
         """
-        # pylint: disable=consider-using-enumerate
-        #         indexation is used for return value
-        for idx in range(start, len(txt)):
-            matches = re.findall(pattern, txt[idx])
-            if matches:
-                return idx
-        # pylint: enable=consider-using-enumerate
-        return -1
+        return shellbox.PatternSet.compile(pattern).search_forward(txt, start)
 
     @staticmethod
     def search_backward(txt, pattern, start=-1):
         """ starting from start_idx searching backward for pattern.
             Returns index or -1 if not found
         """
-        if start < 0:
-            start = len(txt) - 1
-        # pylint: disable=consider-using-enumerate
-        #         indexation is used for return value
-        for idx in range(start, -1, -1):
-            matches = re.findall(pattern, txt[idx])
-            if matches:
-                return idx
-        # pylint: enable=consider-using-enumerate
-        return -1
+        return shellbox.PatternSet.compile(pattern).search_backward(txt, start)
+
+    @staticmethod
+    def search_backward_file(file_name, pattern, end=-1, block_size=1 << 20):
+        """ Last line of the file matching pattern, the file is read
+            backwards: (byte offset, line) or (-1, None), see TextEditor
+        """
+        return shellbox.TextEditor.search_backward_file(file_name, pattern,
+                                                        end, block_size)
+
+    @staticmethod
+    def tail(file_name, count=10, offsets=False):
+        """ Last count lines of the file, read from its end """
+        return shellbox.TextEditor.tail(file_name, count, offsets)
 
     @staticmethod
     def find(txt, pattern):
         """ Returns number of lines matching the pattern """
-        ret_val = []
-        idx = 0
-        for line in txt:
-            matches = re.findall(pattern, line)
-            if matches:
-                ret_val.append(idx)
-            idx += 1
-        return ret_val
+        return shellbox.PatternSet.compile(pattern).find(txt)
+
+    @staticmethod
+    def find_many(txt, patterns):
+        """ Returns line numbers for every pattern, found in one pass """
+        return shellbox.PatternSet.compile(tuple(patterns)).find_all(txt)
 
     @staticmethod
     def find_not(txt, pattern):
         """ Returns number of lines matching the pattern """
-        ret_val = []
-        idx = 0
-        for line in txt:
-            matches = re.findall(pattern, line)
-            if matches:
-                pass
-            else:
-                ret_val.append(idx)
-            idx += 1
-        return ret_val
+        return shellbox.PatternSet.compile(pattern).find_not(txt)
 
     def get_fragment(self, txt, start, stop):
         """ cut fragment of text and return it as new text """
-        filtered = []
         if start < 0:
             start = 0
-        if stop > len(txt):
-            stop = len(txt) - 1
-        for i in range(start, (stop + 1)):
-            filtered.append(txt[i])
-        return filtered
+        if stop < start:
+            return []
+        return list(txt[start:stop + 1])
 
     @staticmethod
     def format(txt, offset="", header="", footer="",
@@ -616,20 +969,19 @@ class Shrec(object):
     @staticmethod
     def replace(txt, pattern, replacement):
         """  replace pattern in all strings """
-        ret_val = []
-        for line in txt:
-            cur = re.sub(pattern, replacement, line)
-            ret_val.append(cur)
-        return ret_val
+        return shellbox.PatternSet.compile(pattern).replace(txt, replacement)
+
+    @staticmethod
+    def remove_duplicates(txt, key=None):
+        """ Remove duplicated lines, order is kept (see TextEditor) """
+        return shellbox.TextEditor.remove_duplicates(txt, key)
 
     @staticmethod
-    def remove_duplicates(txt):
-        """ Remove duplicated lines """
-        output = []
-        for cur_str in txt:
-            if cur_str not in output:
-                output.append(cur_str)
-        return output
+    def iter_unique(lines, key=None, digest=False, spill=''):
+        """ Streaming remove_duplicates for files and iterators, with
+            digests or an on-disk set for huge inputs (see TextEditor)
+        """
+        return shellbox.TextEditor.iter_unique(lines, key, digest, spill)
 
     @staticmethod
     def is_text(val):
@@ -705,44 +1057,29 @@ class Shrec(object):
         ret = [ord(x) for x in s]
         return ret
 
-    def run(self, command_str, working_directory='',
-            comment='', quiet=None, bypass_error=None):
-        """ Run shell command """
-
-        def __parse_shell_output(shell_output_str):
-            """  Parse string received from process to list of
-            strings AKA text """
-            ret_val = []
-            parsed = re.split('[\r\n]+', shell_output_str)
-            for line in parsed:
-                line = line.rstrip()
-                if line != '':
-                    ret_val.append(line)
-            return ret_val
+    @staticmethod
+    def parse_shell_output(shell_output_str):
+        """  Parse string received from process to list of
+        strings AKA text """
+        ret_val = []
+        parsed = re.split('[\r\n]+', shell_output_str)
+        for line in parsed:
+            line = line.rstrip()
+            if line != '':
+                ret_val.append(line)
+        return ret_val
 
-        retval = collections.OrderedDict()
-        retval['function'] = inspect.currentframe().f_code.co_name
-        retval['seconds'] = time.time()
-        retval['command'] = command_str
-        retval['comment'] = comment
+    def __create_run_record(self, function, command_str, comment,
+                            quiet, bypass_error):
+        """ Result structure shared by run() and arun() """
+        retval = shellbox.RunResult(function, command_str, comment,
+                                    stack_mode=self.stack_mode,
+                                    with_allout=self.add_allout)
         retval['stage'] = self.stage
-        retval['status'] = -666
-        retval['dir'] = os.getcwd()
-        retval['diagnostics'] = ''
-        retval['stdout'] = []
-        retval['stderr'] = []
-        retval['flags'] = {}
         retval['flags']['silent'] = False
         retval['flags']['terminate_on_error'] = False
-        retval['process'] = {}
-        retval['process']['pid'] = -666
-        retval['process']['time'] = str(datetime.datetime.now())
-        retval['process']['started'] = time.time()
-        retval['process']['finished'] = retval['process']['started']
-        retval['process']['elapsed'] = -666.0
-        stack = traceback.format_list(traceback.extract_stack())
-        del stack[len(stack) - 1]
-        retval['stack'] = stack
+        # Drop this frame and the frame of run()/arun()
+        retval.capture_stack(skip=2)
 
         if quiet is None:
             quiet = self.args['quiet']
@@ -751,83 +1088,249 @@ class Shrec(object):
         if bypass_error is None:
             bypass_error = self.bypass_error
         retval['flags']['bypass_error'] = bypass_error
+        return retval
+
+    def __complete_run_record(self, retval):
+        """ Log the record, update shell script, exit on error.
+            Allout and raw captured bytes are helpers, the log does not
+            get them (see RunResult.to_dict)
+        """
+        retval['process']['finished'] = time.time()
+        retval['process']['elapsed'] = (retval['process']['finished'] -
+                                        retval['process']['started'])
+
+        bypass_error = retval['flags']['bypass_error']
+        # Failures are errors, or warnings when they are bypassed
+        level = 'info'
+        if retval['status'] != 0:
+            level = 'warn' if bypass_error else 'error'
+        retval['level'] = level
+        self.metrics.observe(retval['stage'], retval.get('argv', retval['command']),
+                             retval['status'], retval['process']['elapsed'])
+        self.__raw_log(retval)
 
-        retval['command'] = command_str
-        retval['comment'] = comment
+        with self.log_lock:
+            if retval['comment']:
+                self.shell_script.append('# %s' % retval['comment'])
+            self.shell_script.append('# Status: %d, Ignore error: %s' %
+                                     (retval['status'], bypass_error))
+            self.shell_script.append('%s' % retval['command'])
+            self.shell_script.append('')
 
-        if command_str == '':
+        if not bypass_error and (retval['status'] != 0):
+            print(retval.to_json(indent=4))
+            exit(retval['status'])
+        return retval
+
+    def run(self, command_str, working_directory='',
+            comment='', quiet=None, bypass_error=None,
+            on_stdout=None, on_stderr=None, capture=None, session=None,
+            terminate_pattern=None, timeout=None, idle_timeout=None,
+            kill_grace=5.0, input=None):
+        """ Run shell command: a string for /bin/sh or an argv list which
+            is executed directly, without the shell
+            on_stdout/on_stderr are called as callback(line, timestamp)
+            for every line as soon as it is received from the child
+            capture selects what is kept of the output: 'full', 'tail:N',
+            'file:PATH', 'discard' or 'raw' (see shellbox.CapturePolicy)
+            session is a shellbox.ShellSession running the command in its
+            long-lived shell, self.session is used by default
+            terminate_pattern (regexp on stdout), timeout and idle_timeout
+            (seconds) stop the command with its whole process group:
+            SIGTERM, then SIGKILL after kill_grace seconds. The reason and
+            teardown time are recorded in retval['termination']
+            input is fed to stdin while output is read: bytes, file name,
+            descriptor or iterator of chunks (see ShellBox.open_input)
+        """
+        retval = self.__create_run_record(inspect.currentframe().f_code.co_name,
+                                          command_str, comment,
+                                          quiet, bypass_error)
+        quiet = retval['flags']['quiet']
+        retval['capture'] = str(shellbox.CapturePolicy(capture))
+
+        if not command_str:
             retval['diagnostics'] = 'Command line is empty'
             retval['status'] = 0
             return retval
 
-        actual_directory = os.getcwd()
+        # Working directory is passed to the child, process cwd is untouched
         if working_directory:
-            os.chdir(working_directory)
-        retval['dir'] = os.getcwd()
+            retval['dir'] = os.path.abspath(working_directory)
+
+        if session is None:
+            session = self.session
+        if session is not None:
+            if (terminate_pattern is not None or timeout is not None or
+                    idle_timeout is not None or input is not None):
+                raise ValueError('terminate_pattern, timeouts and input are '
+                                 'not supported in a ShellSession')
+            session.execute(retval, command_str, quiet,
+                            on_stdout=on_stdout, on_stderr=on_stderr,
+                            capture=capture,
+                            working_directory=working_directory and retval['dir'])
+        else:
+            shellbox.ShellBox.execute(retval, command_str, quiet,
+                                      terminate_pattern=terminate_pattern,
+                                      on_stdout=on_stdout, on_stderr=on_stderr,
+                                      capture=capture, timeout=timeout,
+                                      idle_timeout=idle_timeout,
+                                      kill_grace=kill_grace,
+                                      input_source=input)
+        return self.__complete_run_record(retval)
+
+    async def arun(self, command_str, working_directory='',
+                   comment='', quiet=None, bypass_error=None):
+        """ Coroutine version of run(), does not block the event loop.
+            Command may be an argv list, executed without the shell.
+        """
+        retval = self.__create_run_record(inspect.currentframe().f_code.co_name,
+                                          command_str, comment,
+                                          quiet, bypass_error)
+        quiet = retval['flags']['quiet']
 
-        process = subprocess.Popen(command_str, shell=True,
-                                   stdout=subprocess.PIPE,
-                                   stderr=subprocess.PIPE)
+        if not command_str:
+            retval['diagnostics'] = 'Command line is empty'
+            retval['status'] = 0
+            return retval
 
-        retval['process']['pid'] = process.pid
+        if working_directory:
+            retval['dir'] = os.path.abspath(working_directory)
 
-        if quiet:
-            (raw_output, raw_error) = process.communicate()
-            retval['stdout'] = __parse_shell_output(raw_output.decode('utf-8'))
-            retval['stderr'] = __parse_shell_output(raw_error.decode('utf-8'))
-            retval['status'] = process.returncode
-        else:
-            retval['stdout'] = []
-            empty_count = 0
-            empty_count_treshold = 10
-            for line in iter(process.stdout.readline, ''):
-                line = (line.decode('utf-8')).rstrip()
-                if line == '':
-                    empty_count += 1
-                else:
-                    empty_count = 0
+        lines = shellbox.ShellBox.alines(command_str, retval['dir'], retval)
+        async with contextlib.aclosing(lines):
+            async for (stream_name, line) in lines:
+                if not quiet:
                     print("%s" % line)
-                    retval['stdout'].append(line)
-                if empty_count > empty_count_treshold:
-                    break
+                retval[stream_name].append(line)
 
-            raw_error_list = process.stderr.readlines()
-            retval['stderr'] = []
-            for errline in raw_error_list:
-                line = errline.decode('utf-8')
-                line = line.rstrip()
-                if line != '':
-                    retval['stderr'].append(line)
-            process.stdout.close()
-            process.stderr.close()
-            retval['status'] = process.wait()
+        return self.__complete_run_record(retval)
+
+    def pipeline(self, stages, working_directory='', comment='',
+                 quiet=None, bypass_error=None, pipefail=False):
+        """ Run producer | filter | consumer chain. Stages are shell
+            strings, argv lists or callables func(stdin, stdout) and are
+            connected with OS pipes (see shellbox.ShellBox.execute_pipeline).
+            The chain is logged as one record with per-stage reports
+        """
+        command_str = ' | '.join(shellbox.ShellBox.stage_title(stage)
+                                 for stage in stages)
+        retval = self.__create_run_record(inspect.currentframe().f_code.co_name,
+                                          command_str, comment,
+                                          quiet, bypass_error)
+        if not stages:
+            retval['diagnostics'] = 'Pipeline is empty'
+            retval['status'] = 0
+            return retval
 
         if working_directory:
-            os.chdir(actual_directory)
+            retval['dir'] = os.path.abspath(working_directory)
+
+        shellbox.ShellBox.execute_pipeline(retval, stages,
+                                           retval['flags']['quiet'], pipefail)
+        return self.__complete_run_record(retval)
+
+    def run_cached(self, command_str, working_directory='', comment='',
+                   quiet=None, bypass_error=None, env=(), inputs=(),
+                   hash_inputs=False):
+        """ Run idempotent shell command, reusing the result of an earlier
+            identical run from self.run_cache (in-memory cache is created
+            if none is set). The cache key covers the command, directory,
+            values of environment variables listed in env and mtime/size
+            (or SHA-256 with hash_inputs=True) of files listed in inputs.
+            Only successful results are stored.
+        """
+        if self.run_cache is None:
+            self.run_cache = RunCache()
 
-        retval['process']['finished'] = time.time()
-        retval['process']['elapsed'] = (retval['process']['finished'] -
-                                        retval['process']['started'])
+        retval = self.__create_run_record(inspect.currentframe().f_code.co_name,
+                                          command_str, comment,
+                                          quiet, bypass_error)
+        quiet = retval['flags']['quiet']
+        retval['capture'] = 'full'
 
-        self.__raw_log(retval)
+        if not command_str:
+            retval['diagnostics'] = 'Command line is empty'
+            retval['status'] = 0
+            return retval
 
-        # Allout is a helper and not need to be added to the log
-        if self.add_allout:
-            all_stdout = ' '.join(retval['stdout'])
-            all_stderr = ' '.join(retval['stderr'])
-            retval['allout'] = (all_stdout + ' ' + all_stderr).strip()
-
-        if comment:
-            self.shell_script.append('# %s' % comment)
-        self.shell_script.append('# Status: %d, Ignore error: %s' %
-                                 (retval['status'], bypass_error))
-        self.shell_script.append('%s' % command_str)
-        self.shell_script.append('')
+        if working_directory:
+            retval['dir'] = os.path.abspath(working_directory)
+
+        key = RunCache.make_key(retval['command'], retval['dir'], env,
+                                inputs, hash_inputs)
+        retval['cache'] = {'key': key, 'hit': False}
+        entry = self.run_cache.get(key)
+        if entry is not None:
+            retval['cache']['hit'] = True
+            retval['cache']['stored'] = entry['stored']
+            retval['status'] = entry['status']
+            retval['stdout'] = list(entry['stdout'])
+            retval['stderr'] = list(entry['stderr'])
+            if not quiet:
+                for line in retval['stdout'] + retval['stderr']:
+                    print("%s" % line)
+        else:
+            shellbox.ShellBox.execute(retval, command_str, quiet)
+            if retval['status'] == 0:
+                self.run_cache.put(key, retval)
+        return self.__complete_run_record(retval)
+
+    def run_many(self, commands, max_workers=None, working_directory='',
+                 comment='', quiet=None, bypass_error=None, fail_fast=False):
+        """ Run list of shell commands concurrently, at most max_workers at
+            a time. Returns list of run() results in the input order.
+            With fail_fast=True commands not started yet are skipped after
+            the first failure, otherwise all commands are executed.
+        """
+        # Iterated twice below, a generator would be exhausted
+        commands = list(commands)
 
-        if not bypass_error and (retval['status'] != 0):
-            print(json.dumps(retval, indent=4, ensure_ascii=True))
-            exit(retval['status'])
-        return retval
+        if quiet is None:
+            quiet = self.args['quiet']
+
+        if bypass_error is None:
+            bypass_error = self.bypass_error
+
+        if max_workers is None:
+            max_workers = os.cpu_count() or 1
+
+        # Workers check it before they start the next command
+        failure = threading.Event()
+
+        def __attempt(command_str):
+            if fail_fast and failure.is_set():
+                return None
+            res = self.run(command_str, working_directory, comment,
+                           quiet=quiet, bypass_error=True)
+            if res['status'] != 0:
+                failure.set()
+            return res
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as pool:
+            # Workers see the stage of the caller, not of the pool thread
+            futures = [pool.submit(contextvars.copy_context().run, __attempt,
+                                   command_str) for command_str in commands]
+            results = [future.result() for future in futures]
+
+        failed = None
+        for idx, command_str in enumerate(commands):
+            if results[idx] is None:
+                # Skipped commands are recorded in the log, not in the script
+                res = shellbox.RunResult(inspect.currentframe().f_code.co_name,
+                                         command_str, comment,
+                                         stack_mode='none',
+                                         with_allout=self.add_allout)
+                res['stage'] = self.stage
+                res['diagnostics'] = 'Skipped after failure (fail_fast)'
+                self.__raw_log(res)
+                results[idx] = res
+            elif failed is None and results[idx]['status'] != 0:
+                failed = results[idx]
+
+        if not bypass_error and failed is not None:
+            print(failed.to_json(indent=4))
+            exit(failed['status'])
+        return results
 
     def module_from_file(self, module_name, file_path):
         spec = importlib.util.spec_from_file_location(module_name, file_path)
@@ -836,6 +1339,897 @@ class Shrec(object):
         return module
 # end of class Shrec
 
+class RunCache(object):
+    """ Content-addressed store of run results for Shrec.run_cached().
+        Entries expire after ttl seconds (None -- never), the least
+        recently used entries are evicted above max_entries. With path
+        set every entry is also kept as <path>/<key>.json, so the cache
+        survives between runs.
+    """
+
+    def __init__(self, path='', ttl=None, max_entries=1024):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+        self.entries = collections.OrderedDict()   # key -> entry or None
+        if self.path:
+            os.makedirs(self.path, exist_ok=True)
+            stored = []
+            for file_name in os.listdir(self.path):
+                if file_name.endswith('.json'):
+                    full_name = os.path.join(self.path, file_name)
+                    stored.append((os.path.getmtime(full_name), file_name[:-5]))
+            # Disk entries are loaded on first use, mtime keeps LRU order
+            for (_, key) in sorted(stored):
+                self.entries[key] = None
+
+    @staticmethod
+    def make_key(command_str, working_directory, env=(), inputs=(),
+                 hash_inputs=False):
+        """ SHA-256 over everything the command result depends on """
+        source = collections.OrderedDict()
+        source['command'] = command_str
+        source['dir'] = working_directory
+        source['env'] = [[name, os.environ.get(name)] for name in env]
+        source['inputs'] = []
+        for file_name in inputs:
+            file_name = os.path.abspath(file_name)
+            if not os.path.isfile(file_name):
+                state = None
+            elif hash_inputs:
+                digest = hashlib.sha256()
+                with open(file_name, 'rb') as input_file:
+                    for block in iter(lambda: input_file.read(1 << 20), b''):
+                        digest.update(block)
+                state = digest.hexdigest()
+            else:
+                stat = os.stat(file_name)
+                state = [stat.st_mtime_ns, stat.st_size]
+            source['inputs'].append([file_name, state])
+        return hashlib.sha256(json.dumps(source).encode('utf-8')).hexdigest()
+
+    def __file_name(self, key):
+        return os.path.join(self.path, '%s.json' % key)
+
+    def get(self, key):
+        """ Entry stored for key or None if missing or expired """
+        with self.lock:
+            if key not in self.entries:
+                return None
+            entry = self.entries[key]
+            if entry is None:
+                try:
+                    with open(self.__file_name(key), 'r') as entry_file:
+                        entry = json.load(entry_file)
+                except (IOError, ValueError):
+                    self.__remove(key)
+                    return None
+                self.entries[key] = entry
+            if self.ttl is not None and time.time() - entry['stored'] > self.ttl:
+                self.__remove(key)
+                return None
+            self.entries.move_to_end(key)
+            if self.path:
+                os.utime(self.__file_name(key))
+            return entry
+
+    def put(self, key, retval):
+        """ Store the result of a run under key """
+        entry = collections.OrderedDict()
+        entry['stored'] = time.time()
+        entry['command'] = retval['command']
+        entry['dir'] = retval['dir']
+        entry['status'] = retval['status']
+        entry['stdout'] = list(retval['stdout'])
+        entry['stderr'] = list(retval['stderr'])
+        with self.lock:
+            self.entries[key] = entry
+            self.entries.move_to_end(key)
+            if self.path:
+                with open(self.__file_name(key), 'w') as entry_file:
+                    json.dump(entry, entry_file)
+            while len(self.entries) > self.max_entries:
+                self.__remove(next(iter(self.entries)))
+
+    def __remove(self, key):
+        del self.entries[key]
+        if self.path and os.path.exists(self.__file_name(key)):
+            os.remove(self.__file_name(key))
+
+    def invalidate(self, key=None, command=None):
+        """ Drop one entry by key, all entries of a command, or everything
+            when neither is given. Returns number of removed entries.
+        """
+        with self.lock:
+            if key is not None:
+                victims = [key] if key in self.entries else []
+            elif command is not None:
+                victims = []
+                for cur_key in list(self.entries.keys()):
+                    entry = self.entries[cur_key]
+                    if entry is None:
+                        try:
+                            with open(self.__file_name(cur_key), 'r') as entry_file:
+                                entry = json.load(entry_file)
+                        except (IOError, ValueError):
+                            entry = {'command': command}
+                    if entry['command'] == command:
+                        victims.append(cur_key)
+            else:
+                victims = list(self.entries.keys())
+            for cur_key in victims:
+                self.__remove(cur_key)
+            return len(victims)
+# end of class RunCache
+
+class LogWriter(object):
+    """ Buffered JSON Lines log sink used by Shrec for its log file.
+        Records are serialized by the calling thread and written in
+        batches of batch_size records, at least every flush_interval
+        seconds, by a background thread (or inline with background=False).
+        fsync: 'never', 'batch' (after every batch write) or 'always'
+        (every record is written and synced before write() returns).
+        Buffered records are flushed by close(), flush() and at exit.
+
+        Rotation: once the file holds max_bytes or is max_seconds old it
+        is renamed to FILE.000001, FILE.000002... and a new file is started
+        with the record returned by segment_header(previous_segment_name).
+        Segments are cut between records, so each one is a valid JSON Lines
+        file. A second background thread compresses them ('gz' or 'xz')
+        and removes all but the last 'keep' segments.
+    """
+
+    fsync_policies = ('never', 'batch', 'always')
+    compressors = {'': None, 'gz': gzip.open, 'xz': lzma.open}
+
+    def __init__(self, file_name, append=True, flush_interval=1.0,
+                 batch_size=100, fsync='never', background=True,
+                 max_bytes=None, max_seconds=None, compress='gz', keep=None,
+                 segment_header=None):
+        if fsync not in LogWriter.fsync_policies:
+            raise ValueError('Unknown fsync policy %s' % fsync)
+        if compress not in LogWriter.compressors:
+            raise ValueError('Unknown compression %s' % compress)
+        self.file_name = file_name
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.fsync = fsync
+        self.max_bytes = max_bytes
+        self.max_seconds = max_seconds
+        self.compress = compress
+        self.keep = keep
+        self.segment_header = segment_header
+        self.log_file = open(file_name, 'a' if append else 'w',
+                             encoding='utf-8')
+        self.segment_size = self.log_file.tell()
+        self.segment_started = time.time()
+        self.pending = []
+        self.last_flush = time.time()
+        self.closed = False
+        self.condition = threading.Condition()
+        self.thread = None
+        self.archiver = None
+        self.archive_queue = queue.Queue()
+        if background:
+            self.thread = threading.Thread(target=self.__background,
+                                           name='shrec-log-writer')
+            self.thread.daemon = True
+            self.thread.start()
+        atexit.register(self.close)
+
+    def write(self, record):
+        """ Queue one record """
+        line = json.dumps(shellbox.RunResult.loggable(record), ensure_ascii=True)
+        with self.condition:
+            if self.closed:
+                raise ValueError('Log %s is closed' % self.file_name)
+            self.pending.append(line)
+            if self.fsync == 'always':
+                self.__write_pending()
+            elif len(self.pending) >= self.batch_size:
+                if self.thread is None:
+                    self.__write_pending()
+                else:
+                    self.condition.notify()
+            elif (self.thread is None and
+                  time.time() - self.last_flush >= self.flush_interval):
+                self.__write_pending()
+
+    def __write_pending(self):
+        """ Write queued records, the caller holds self.condition. Rotation
+            is checked before every record, not once per batch
+        """
+        if self.pending:
+            block = []
+            for line in self.pending:
+                if self.__rotation_due():
+                    self.__write_block(block)
+                    block = []
+                    self.__rotate()
+                block.append(line)
+                self.segment_size += len(line) + 1  # ensure_ascii: chars == bytes
+            self.pending = []
+            self.__write_block(block)
+            if self.fsync != 'never':
+                os.fsync(self.log_file.fileno())
+        self.last_flush = time.time()
+
+    def __write_block(self, block):
+        if block:
+            self.log_file.write('\n'.join(block) + '\n')
+            self.log_file.flush()
+
+    def __rotation_due(self):
+        if self.segment_size == 0:
+            return False
+        if self.max_bytes is not None and self.segment_size >= self.max_bytes:
+            return True
+        return (self.max_seconds is not None and
+                time.time() - self.segment_started >= self.max_seconds)
+
+    def __rotate(self):
+        """ Close the active file as the next segment, start a new one """
+        existing = LogWriter.list_segments(self.file_name)
+        number = 1
+        if existing:
+            number = LogWriter.segment_number(self.file_name, existing[-1]) + 1
+        segment = '%s.%06d' % (self.file_name, number)
+        if self.fsync != 'never':
+            os.fsync(self.log_file.fileno())
+        self.log_file.close()
+        os.rename(self.file_name, segment)
+        self.log_file = open(self.file_name, 'w', encoding='utf-8')
+        self.segment_size = 0
+        self.segment_started = time.time()
+        if self.segment_header is not None:
+            header = self.segment_header(os.path.basename(segment))
+            header = json.dumps(header, ensure_ascii=True) + '\n'
+            self.log_file.write(header)
+            self.segment_size += len(header)
+        if self.archiver is None:
+            self.archiver = threading.Thread(target=self.__archive,
+                                             name='shrec-log-archiver')
+            self.archiver.daemon = True
+            self.archiver.start()
+        self.archive_queue.put(segment)
+
+    def __archive(self):
+        """ Compress rotated segments and apply the retention count """
+        while True:
+            segment = self.archive_queue.get()
+            if segment is None:
+                return
+            compressor = LogWriter.compressors[self.compress]
+            if compressor is not None:
+                archive = '%s.%s' % (segment, self.compress)
+                with open(segment, 'rb') as source, \
+                        compressor(archive + '.tmp', 'wb') as target:
+                    shutil.copyfileobj(source, target, 1 << 20)
+                # Readers never see a partially written archive
+                os.rename(archive + '.tmp', archive)
+                os.remove(segment)
+            if self.keep is not None:
+                segments = LogWriter.list_segments(self.file_name)
+                for old_segment in segments[:max(len(segments) - self.keep, 0)]:
+                    os.remove(old_segment)
+
+    @staticmethod
+    def list_segments(file_name):
+        """ Rotated segments of file_name, oldest first """
+        segments = {}
+        for segment in sorted(glob.glob(glob.escape(file_name) + '.[0-9]*')):
+            number = LogWriter.segment_number(file_name, segment)
+            # While being compressed a segment exists in both forms
+            if number is not None and number not in segments:
+                segments[number] = segment
+        return [segments[number] for number in sorted(segments)]
+
+    @staticmethod
+    def segment_number(file_name, segment):
+        """ 'run.log.000012.gz' --> 12, None for other files """
+        match = re.fullmatch(r'\.(\d+)(\.gz|\.xz)?', segment[len(file_name):])
+        return int(match.group(1)) if match is not None else None
+
+    @staticmethod
+    def open_segment(file_name):
+        """ Open a plain, .gz or .xz log file as text """
+        for (extension, compressor) in LogWriter.compressors.items():
+            if extension and file_name.endswith('.' + extension):
+                return compressor(file_name, 'rt', encoding='utf-8', errors='replace')
+        return open(file_name, 'r', encoding='utf-8', errors='replace')
+
+    def __background(self):
+        with self.condition:
+            while not self.closed:
+                self.condition.wait(self.flush_interval)
+                self.__write_pending()
+
+    def flush(self):
+        """ Write all queued records now """
+        with self.condition:
+            if not self.closed:
+                self.__write_pending()
+
+    def close(self):
+        """ Flush and close the file, stop the background thread """
+        with self.condition:
+            if self.closed:
+                return
+            self.__write_pending()
+            self.closed = True
+            self.log_file.close()
+            self.condition.notify()
+        if self.thread is not None and self.thread is not threading.current_thread():
+            self.thread.join()
+        if self.archiver is not None:
+            self.archive_queue.put(None)
+            self.archiver.join()
+        atexit.unregister(self.close)
+# end of class LogWriter
+
+class RecordStore(list):
+    """ Container of Shrec.log_records with a retention policy: a list of
+        the retained records. Above max_records records or max_bytes of
+        serialized JSON the oldest records are evicted; with spill set to
+        a file name they are appended to that gzip-compressed JSON Lines
+        segment, and iter_all() yields them before the retained ones.
+    """
+
+    def __init__(self, max_records=None, max_bytes=None, spill=''):
+        super(RecordStore, self).__init__()
+        self.max_records = max_records
+        self.max_bytes = max_bytes
+        self.spill = spill
+        self.sizes = []
+        self.size = 0
+        self.evicted = 0
+        self.spilled = 0
+        self.spill_file = None
+        self.lock = threading.RLock()
+
+    @staticmethod
+    def __serialize(record):
+        return json.dumps(shellbox.RunResult.loggable(record), ensure_ascii=True)
+
+    def __reduce__(self):
+        """ Pickle and copy as a plain list of the retained records """
+        return (list, (list(self),))
+
+    def append(self, record):
+        """ Add the record, evict the oldest ones over the limits """
+        with self.lock:
+            super(RecordStore, self).append(record)
+            # Serialized size is only needed when bytes are limited
+            if self.max_bytes is not None:
+                record_size = len(self.__serialize(record))
+                self.sizes.append(record_size)
+                self.size += record_size
+            self.__evict()
+
+    def extend(self, records):
+        for record in records:
+            self.append(record)
+
+    def __iadd__(self, records):
+        self.extend(records)
+        return self
+
+    def __changed(self):
+        """ Recount sizes and apply the limits after any other change """
+        if self.max_bytes is not None:
+            self.sizes = [len(self.__serialize(record)) for record in self]
+            self.size = sum(self.sizes)
+        self.__evict()
+
+    def insert(self, idx, record):
+        with self.lock:
+            super(RecordStore, self).insert(idx, record)
+            self.__changed()
+
+    def __setitem__(self, idx, value):
+        with self.lock:
+            super(RecordStore, self).__setitem__(idx, value)
+            self.__changed()
+
+    def __delitem__(self, idx):
+        with self.lock:
+            super(RecordStore, self).__delitem__(idx)
+            self.__changed()
+
+    def __imul__(self, times):
+        with self.lock:
+            super(RecordStore, self).__imul__(times)
+            self.__changed()
+        return self
+
+    def pop(self, idx=-1):
+        with self.lock:
+            record = super(RecordStore, self).pop(idx)
+            self.__changed()
+            return record
+
+    def remove(self, record):
+        with self.lock:
+            super(RecordStore, self).remove(record)
+            self.__changed()
+
+    def clear(self):
+        with self.lock:
+            super(RecordStore, self).clear()
+            self.__changed()
+
+    def sort(self, *args, **kwargs):
+        with self.lock:
+            super(RecordStore, self).sort(*args, **kwargs)
+            self.__changed()
+
+    def reverse(self):
+        with self.lock:
+            super(RecordStore, self).reverse()
+            self.__changed()
+
+    def __evict(self):
+        """ Drop, and spill, the oldest records over the limits at once """
+        count = 0
+        if self.max_records is not None:
+            count = max(0, len(self) - self.max_records)
+        if self.max_bytes is not None:
+            size = self.size - sum(self.sizes[:count])
+            while count < len(self) and size > self.max_bytes:
+                size -= self.sizes[count]
+                count += 1
+            self.size = size
+            del self.sizes[:count]
+        if not count:
+            return
+        self.evicted += count
+        if self.spill:
+            if self.spill_file is None:
+                # After close() a new gzip member is appended to the segment
+                mode = 'at' if self.spilled else 'wt'
+                self.spill_file = gzip.open(self.spill, mode, encoding='utf-8')
+                atexit.register(self.close)
+            for record in self[:count]:
+                self.spill_file.write(self.__serialize(record))
+                self.spill_file.write('\n')
+            self.spilled += count
+        super(RecordStore, self).__delitem__(slice(0, count))
+
+    def iter_spilled(self):
+        """ Lazily read evicted records back from the spill segment, also
+            after close()
+        """
+        with self.lock:
+            if not self.spilled:
+                return
+            if self.spill_file is not None:
+                # Make everything written so far readable
+                self.spill_file.flush()
+                self.spill_file.buffer.flush(zlib.Z_SYNC_FLUSH)
+            spilled = self.spilled
+        with gzip.open(self.spill, 'rt', encoding='utf-8') as spill_file:
+            try:
+                for (idx, line) in enumerate(spill_file):
+                    if idx >= spilled:
+                        return
+                    yield json.loads(line)
+            except EOFError:
+                # Segment is still open, there is no gzip trailer yet
+                return
+
+    def iter_all(self):
+        """ Spilled records followed by the retained ones """
+        yield from self.iter_spilled()
+        with self.lock:
+            retained = list(self)
+        yield from retained
+
+    def stats(self):
+        """ Memory usage report """
+        with self.lock:
+            ret_val = collections.OrderedDict()
+            ret_val['records'] = len(self)
+            ret_val['bytes'] = self.size if self.max_bytes is not None else None
+            ret_val['max_records'] = self.max_records
+            ret_val['max_bytes'] = self.max_bytes
+            ret_val['evicted'] = self.evicted
+            ret_val['spilled'] = self.spilled
+            ret_val['spill'] = self.spill
+            ret_val['spill_bytes'] = (os.path.getsize(self.spill)
+                                      if self.spilled else 0)
+            return ret_val
+
+    def close(self):
+        """ Finish the spill segment, it stays on disk and readable. Later
+            evictions append to it
+        """
+        with self.lock:
+            if self.spill_file is not None:
+                self.spill_file.close()
+                self.spill_file = None
+                atexit.unregister(self.close)
+# end of class RecordStore
+
+class LogIndex(object):
+    """ Query engine for Shrec log files. Every segment of the log (see
+        Shrec.log_segments) gets a sidecar index SEGMENT.idx with one
+        entry per record: time, stage, function, status, elapsed and
+        command, plus the record position. Indexes of the active file are
+        extended incrementally; compressed segments are indexed once.
+
+            index = LogIndex('run.log')
+            index.query(stage='build', failed=True,
+                        since='2020-02-02 01:00', until='2020-02-02 05:00')
+            index.query(slowest=20)
+    """
+
+    version = 1
+    columns = ('seconds', 'stage', 'function', 'status', 'elapsed', 'command',
+               'line', 'offset')
+    command_limit = 1000
+
+    def __init__(self, file_name):
+        self.file_name = file_name
+
+    @staticmethod
+    def index_name(segment):
+        return segment + '.idx'
+
+    @staticmethod
+    def __entry(record, line, offset):
+        """ Index entry of one record, see columns """
+        status = None
+        elapsed = None
+        if isinstance(record.get('process'), dict):
+            elapsed = record['process'].get('elapsed')
+        if 'status' in record:
+            status = record['status']
+        command = record.get('command')
+        if command is None:
+            command = record.get('message')
+        if command is not None:
+            command = str(command)[:LogIndex.command_limit]
+        return [record.get('seconds'), record.get('stage'), record.get('function'),
+                status, elapsed, command, line, offset]
+
+    @staticmethod
+    def __source_state(segment):
+        stat = os.stat(segment)
+        return {'size': stat.st_size, 'mtime': stat.st_mtime, 'inode': stat.st_ino}
+
+    def __scan(self, segment, index):
+        """ Add entries for records after index['scanned'] (plain JSON
+            Lines file) or rebuild the index (compressed or legacy file)
+        """
+        if segment.endswith('.gz') or segment.endswith('.xz'):
+            index['entries'] = []
+            with LogWriter.open_segment(segment) as log_file:
+                for (line_number, line) in enumerate(log_file):
+                    try:
+                        record = json.loads(line)
+                    except ValueError:
+                        continue
+                    index['entries'].append(self.__entry(record, line_number, None))
+            return
+        with open(segment, 'rb') as log_file:
+            if log_file.read(1) == b'[':
+                # Legacy format, record positions are not known
+                index['entries'] = [self.__entry(record, line_number, None)
+                                    for (line_number, record)
+                                    in enumerate(Shrec.iter_log(segment))]
+                index['scanned'] = 0
+                return
+            log_file.seek(index['scanned'])
+            line_number = index['lines']
+            for line in log_file:
+                if not line.endswith(b'\n'):
+                    break   # record is being written, take it next time
+                offset = index['scanned']
+                index['scanned'] += len(line)
+                index['lines'] += 1
+                try:
+                    record = json.loads(line.decode('utf-8', errors='replace'))
+                except ValueError:
+                    continue
+                index['entries'].append(self.__entry(record, line_number, offset))
+                line_number += 1
+
+    def update(self, rebuild=False):
+        """ Bring sidecar indexes of all segments up to date, remove the
+            ones left from deleted segments. Returns {segment: entries}
+        """
+        ret_val = collections.OrderedDict()
+        segments = Shrec.log_segments(self.file_name)
+        for segment in segments:
+            index_file = self.index_name(segment)
+            state = self.__source_state(segment)
+            index = None
+            if not rebuild and os.path.exists(index_file):
+                try:
+                    with open(index_file, 'r') as idx_file:
+                        index = json.load(idx_file)
+                except ValueError:
+                    index = None
+            if index is not None:
+                source = index.get('source', {})
+                if index.get('version') != self.version or \
+                        source.get('inode') != state['inode'] or \
+                        source.get('size', 0) > state['size']:
+                    index = None    # Different or truncated file
+                elif source == state:
+                    ret_val[segment] = index['entries']
+                    continue
+                elif index.get('scanned') is None:
+                    index = None    # Compressed segment was replaced
+            if index is None:
+                index = {'version': self.version, 'columns': list(self.columns),
+                         'scanned': 0, 'lines': 0, 'entries': []}
+            self.__scan(segment, index)
+            index['source'] = state
+            with open(index_file + '.tmp', 'w') as idx_file:
+                json.dump(index, idx_file, separators=(',', ':'))
+            os.rename(index_file + '.tmp', index_file)
+            ret_val[segment] = index['entries']
+        # Indexes of segments removed by the retention policy
+        for index_file in glob.glob(glob.escape(self.file_name) + '.*.idx'):
+            if index_file[:-len('.idx')] not in segments:
+                os.remove(index_file)
+        return ret_val
+
+    @staticmethod
+    def parse_time(value):
+        """ Epoch seconds or 'YYYY-MM-DD[ HH:MM[:SS]]' --> epoch seconds """
+        if value is None or isinstance(value, (int, float)):
+            return value
+        try:
+            return float(value)
+        except ValueError:
+            return datetime.datetime.fromisoformat(value).timestamp()
+
+    def query(self, stage=None, function=None, status=None, failed=False,
+              command=None, since=None, until=None, slowest=None, limit=None,
+              runs_only=False, rebuild=False):
+        """ Entries matching all given conditions, in log order, or the
+            'slowest' N of them by elapsed time. command is a regular
+            expression searched in the command text. Each entry is a dict
+            with the index columns and 'segment'
+        """
+        since = self.parse_time(since)
+        until = self.parse_time(until)
+        command_re = re.compile(command) if command is not None else None
+        if failed or slowest is not None:
+            runs_only = True
+        ret_val = []
+        for (segment, entries) in self.update(rebuild).items():
+            for entry in entries:
+                (seconds, entry_stage, entry_function, entry_status, elapsed,
+                 entry_command) = entry[:6]
+                if runs_only and elapsed is None:
+                    continue
+                if stage is not None and entry_stage != stage:
+                    continue
+                if function is not None and entry_function != function:
+                    continue
+                if status is not None and entry_status != status:
+                    continue
+                if failed and entry_status in (0, None):
+                    continue
+                if since is not None and (seconds is None or seconds < since):
+                    continue
+                if until is not None and (seconds is None or seconds > until):
+                    continue
+                if command_re is not None and (
+                        entry_command is None or not command_re.search(entry_command)):
+                    continue
+                found = dict(zip(self.columns, entry))
+                found['segment'] = segment
+                ret_val.append(found)
+        if slowest is not None:
+            ret_val = sorted(ret_val, key=lambda x: x['elapsed'], reverse=True)[:slowest]
+        if limit is not None:
+            ret_val = ret_val[:limit]
+        return ret_val
+
+    @staticmethod
+    def records(entries):
+        """ Full log records of query() results: seek in plain files,
+            one streaming pass per compressed segment
+        """
+        ret_val = [None] * len(entries)
+        by_segment = collections.defaultdict(list)
+        for (idx, entry) in enumerate(entries):
+            by_segment[entry['segment']].append(idx)
+        for (segment, positions) in by_segment.items():
+            if all(entries[idx]['offset'] is not None for idx in positions):
+                with open(segment, 'rb') as log_file:
+                    for idx in positions:
+                        log_file.seek(entries[idx]['offset'])
+                        ret_val[idx] = json.loads(log_file.readline().decode(
+                            'utf-8', errors='replace'))
+                continue
+            wanted = {entries[idx]['line']: idx for idx in positions}
+            for (line_number, record) in enumerate(Shrec.iter_log(segment)):
+                if line_number in wanted:
+                    ret_val[wanted[line_number]] = record
+        return ret_val
+
+    @staticmethod
+    def main(arg_list):
+        """ Command line: shrec.py log FILE [conditions] """
+        parser = argparse.ArgumentParser(prog='shrec.py log',
+                                         description='Query shrec log files')
+        parser.add_argument("logname", action="store",
+                            help="Log file, rotated segments are included")
+        parser.add_argument("--stage", action="store", default=None)
+        parser.add_argument("--function", action="store", default=None)
+        parser.add_argument("--status", action="store", type=int, default=None)
+        parser.add_argument("--failed", action="store_true",
+                            help="Commands with non-zero status")
+        parser.add_argument("--command", action="store", default=None,
+                            help="Regular expression searched in commands")
+        parser.add_argument("--since", action="store", default=None,
+                            help="Epoch seconds or YYYY-MM-DD[ HH:MM[:SS]]")
+        parser.add_argument("--until", action="store", default=None)
+        parser.add_argument("--slowest", action="store", type=int, default=None)
+        parser.add_argument("--limit", action="store", type=int, default=None)
+        parser.add_argument("--runs", action="store_true",
+                            help="Only command records, no log messages")
+        parser.add_argument("--records", action="store_true",
+                            help="Print full records as JSON Lines")
+        parser.add_argument("--rebuild", action="store_true",
+                            help="Rebuild sidecar indexes")
+        args = parser.parse_args(arg_list)
+        index = LogIndex(args.logname)
+        found = index.query(stage=args.stage, function=args.function,
+                            status=args.status, failed=args.failed,
+                            command=args.command, since=args.since,
+                            until=args.until, slowest=args.slowest,
+                            limit=args.limit, runs_only=args.runs,
+                            rebuild=args.rebuild)
+        if args.records:
+            for record in LogIndex.records(found):
+                print(json.dumps(record, ensure_ascii=True))
+            return 0
+        for entry in found:
+            when = ''
+            if entry['seconds'] is not None:
+                when = datetime.datetime.fromtimestamp(entry['seconds']).strftime(
+                    '%Y-%m-%d %H:%M:%S')
+            elapsed = '%.3f' % entry['elapsed'] if entry['elapsed'] is not None else '-'
+            status = entry['status'] if entry['status'] is not None else '-'
+            print('%s %-12s %4s %9s  %s' % (when, entry['stage'] or '-', status,
+                                            elapsed, entry['command']))
+        return 0
+# end of class LogIndex
+
+class Metrics(object):
+    """ Counters and latency histograms of run() commands per stage and
+        per command prefix (program name), rendered in the Prometheus
+        text exposition format. observe() is O(1): a dict lookup and a
+        search in the fixed bucket list.
+
+            metrics.write_textfile('/var/lib/node_exporter/textfile/job.prom')
+            metrics.serve(9464)   # http://127.0.0.1:9464/metrics
+    """
+
+    buckets = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0,
+               30.0, 60.0, 300.0, 900.0, 3600.0)
+
+    def __init__(self, recipe='', buckets=None):
+        if buckets is not None:
+            self.buckets = tuple(sorted(buckets))
+        self.recipe = recipe or os.path.basename(sys.argv[0] if sys.argv else '')
+        self.series = {}
+        self.lock = threading.Lock()
+        self.server = None
+
+    @staticmethod
+    def command_prefix(command):
+        """ 'FOO=1 /usr/bin/make -j8 all' --> 'make' """
+        if isinstance(command, (list, tuple)):
+            words = list(command)
+        else:
+            words = str(command).split()
+        for word in words:
+            if '=' in word and not word.startswith(('/', '.')):
+                continue    # Environment assignment
+            return os.path.basename(word) or word
+        return ''
+
+    def observe(self, stage, command, status, elapsed):
+        """ Account one completed command """
+        key = (stage or '', self.command_prefix(command))
+        bucket = bisect.bisect_left(self.buckets, elapsed)
+        with self.lock:
+            series = self.series.get(key)
+            if series is None:
+                # count, failures, sum, per-bucket counts (+Inf last)
+                series = [0, 0, 0.0, [0] * (len(self.buckets) + 1)]
+                self.series[key] = series
+            series[0] += 1
+            series[1] += status != 0
+            series[2] += elapsed
+            series[3][bucket] += 1
+
+    @staticmethod
+    def __label(value):
+        return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+    def render(self):
+        """ Prometheus text exposition of all series """
+        with self.lock:
+            series = sorted((key, [value[0], value[1], value[2], list(value[3])])
+                            for (key, value) in self.series.items())
+        lines = []
+        names = (('shrec_commands_total', 'counter', 'Commands executed by run()'),
+                 ('shrec_command_failures_total', 'counter', 'Commands with non-zero status'),
+                 ('shrec_command_duration_seconds', 'histogram', 'Command wall time'))
+        for (idx, (name, kind, help_str)) in enumerate(names):
+            lines.append('# HELP %s %s' % (name, help_str))
+            lines.append('# TYPE %s %s' % (name, kind))
+            for ((stage, prefix), (count, failures, total, counts)) in series:
+                labels = 'recipe="%s",stage="%s",command="%s"' % (
+                    self.__label(self.recipe), self.__label(stage), self.__label(prefix))
+                if idx == 0:
+                    lines.append('%s{%s} %d' % (name, labels, count))
+                elif idx == 1:
+                    lines.append('%s{%s} %d' % (name, labels, failures))
+                else:
+                    cumulative = 0
+                    for (bound, bucket_count) in zip(self.buckets + (float('inf'),), counts):
+                        cumulative += bucket_count
+                        lines.append('%s_bucket{%s,le="%s"} %d' % (
+                            name, labels, '+Inf' if bound == float('inf') else repr(bound),
+                            cumulative))
+                    lines.append('%s_sum{%s} %r' % (name, labels, total))
+                    lines.append('%s_count{%s} %d' % (name, labels, count))
+        lines.append('# HELP shrec_metrics_timestamp_seconds Time of the metrics snapshot')
+        lines.append('# TYPE shrec_metrics_timestamp_seconds gauge')
+        lines.append('shrec_metrics_timestamp_seconds{recipe="%s"} %r' % (
+            self.__label(self.recipe), time.time()))
+        return '\n'.join(lines) + '\n'
+
+    def write_textfile(self, file_name):
+        """ Atomically replace file_name, as the node exporter textfile
+            collector requires
+        """
+        temp_name = '%s.%d.tmp' % (file_name, os.getpid())
+        with open(temp_name, 'w') as metrics_file:
+            metrics_file.write(self.render())
+        os.rename(temp_name, file_name)
+
+    def serve(self, port, address='127.0.0.1'):
+        """ Serve render() on http://address:port/metrics from a daemon
+            thread. Returns the server, stop it with server.shutdown()
+        """
+        import http.server  # pylint: disable=import-outside-toplevel
+        metrics = self
+
+        class MetricsHandler(http.server.BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split('?')[0] not in ('/', '/metrics'):
+                    self.send_error(404)
+                    return
+                body = metrics.render().encode('utf-8')
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+
+        self.server = http.server.ThreadingHTTPServer((address, port), MetricsHandler)
+        thread = threading.Thread(target=self.server.serve_forever,
+                                  name='shrec-metrics')
+        thread.daemon = True
+        thread.start()
+        return self.server
+# end of class Metrics
+
+
 class Runner(Shrec):
     """ Dummy, but quick child to perform simple operations """
     def __init__(self):
@@ -863,12 +2257,20 @@ if __name__ == "__main__":
         install_script.append('setup(name="%s",version="%s",' % (__module__, __version__))
         install_script.append('      author="%s",' % __author__)
         install_script.append('      author_email="%s",' % __email__)
-        install_script.append('      py_modules=["shrec"])')
+        install_script.append('      py_modules=["shrec", "shellbox"])')
         runner = Runner()
         runner.save_file(install_script, 'temp_setup.py')
         runner.run('python   temp_setup.py install')
         runner.run('rm -f temp_setup.py')
         exit(0)
     # end of install
+    if arglist[0] == 'log':
+        exit(LogIndex.main(arglist[1:]))
+    if arglist[0] == 'trace':
+        # shrec.py trace LOGNAME [TRACE.json]
+        trace_name = arglist[2] if len(arglist) > 2 else arglist[1] + '.trace.json'
+        Runner().export_trace(trace_name, log_file=arglist[1])
+        print('Trace saved to %s' % trace_name)
+        exit(0)
     print('Unsupported argument "%s"' % arglist[0])
     exit(-1)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+""" Micro-benchmarks for shellbox/shrec execution paths
+
+    python3 tools/benchmark.py session --count 500
+    python3 tools/benchmark.py threads      # stress test, exit status 1 on failure
+"""
+import argparse
+import os
+import sys
+import tempfile
+import threading
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+import shellbox  # pylint: disable=wrong-import-position
+
+
+def measure(title, count, func):
+    """ Call func(idx) count times, print and return seconds per call """
+    started = time.perf_counter()
+    for idx in range(count):
+        func(idx)
+    elapsed = time.perf_counter() - started
+    per_call = elapsed / count
+    print("%-40s %8d calls %10.3f s %12.1f us/call" %
+          (title, count, elapsed, per_call * 1e6))
+    return per_call
+#---
+
+
+def bench_session(count=200):
+    """ Persistent ShellSession against new shell per command """
+    commands = ['test -f /etc/hostname', 'true', 'echo %d']
+    for command in commands:
+        popen = measure('ShellBox.run: %s' % command, count,
+                        lambda idx, c=command: shellbox.ShellBox.run(
+                            c.replace('%d', str(idx)), quiet=True, bypass_error=True))
+        with shellbox.ShellSession() as session:
+            session.run('true', quiet=True)     # exclude shell startup
+            framed = measure('ShellSession.run: %s' % command, count,
+                             lambda idx, c=command: session.run(
+                                 c.replace('%d', str(idx)), quiet=True, bypass_error=True))
+        print("%-40s %8.1fx" % ('speedup', popen / framed))
+#---
+
+
+def bench_spawn(count=200):
+    """ Spawn latency: command string through /bin/sh against argv list """
+    for (title, command) in [('shell', 'true'), ('shell', '/bin/echo x'),
+                             ('argv', ['true']), ('argv', ['/bin/echo', 'x'])]:
+        measure('ShellBox.run %s: %s' % (title, command), count,
+                lambda idx, c=command: shellbox.ShellBox.run(c, quiet=True))
+#---
+
+
+def bench_threads(count=1000):
+    """ Stress test: one Shrec object shared by 32 threads, each thread
+        with its own stage. Checks that no record, log entry or script
+        line is lost or interleaved: 1000 commands by default.
+        Returns False on any error, the script then exits with status 1
+    """
+    import shrec  # pylint: disable=import-outside-toplevel
+    threads_number = 32
+    start_dir = os.getcwd()
+    runner = shrec.Runner()
+    runner.logname = os.path.join(tempfile.mkdtemp(), 'threads.log')
+    header = len(runner.shell_script)
+    errors = []
+
+    def __worker(thread_idx):
+        runner.stage = 'thread_%d' % thread_idx
+        for idx in range(thread_idx, count, threads_number):
+            try:
+                res = runner.run(['echo', 'cmd_%d' % idx], quiet=True,
+                                 working_directory='/tmp' if idx % 2 else '/')
+            except Exception as error:  # pylint: disable=broad-except
+                errors.append('cmd_%d raised %r' % (idx, error))
+                continue
+            if res['stdout'] != ['cmd_%d' % idx]:
+                errors.append('cmd_%d returned %s' % (idx, res['stdout']))
+            if res['stage'] != runner.stage:
+                errors.append('cmd_%d returned in stage %s' % (idx, res['stage']))
+
+    started = time.perf_counter()
+    workers = [threading.Thread(target=__worker, args=(idx,))
+               for idx in range(threads_number)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+    elapsed = time.perf_counter() - started
+
+    if len(runner.log_records) != count:
+        errors.append('%d records instead of %d' % (len(runner.log_records), count))
+    for record in runner.log_records:
+        idx = int(record['stdout'][0][4:])
+        if record['stage'] != 'thread_%d' % (idx % threads_number):
+            errors.append('%s recorded in stage %s' % (record['command'], record['stage']))
+    script = runner.shell_script[header:]
+    # Three lines per command: status comment, command, empty line
+    for pos in range(0, len(script), 3):
+        if not (script[pos].startswith('# Status') and script[pos + 1].startswith('echo cmd_')
+                and script[pos + 2] == ''):
+            errors.append('shell_script interleaved at line %d' % (header + pos))
+            break
+    runner.flush_log()
+    logged = shrec.Shrec.read_log(runner.logname)
+    if len(logged) != count:
+        errors.append('%d log file records instead of %d' % (len(logged), count))
+    if os.getcwd() != start_dir:
+        errors.append('process cwd changed to %s' % os.getcwd())
+    print("%-40s %8d calls %10.3f s %s" % ('Shrec.run from %d threads' % threads_number,
+                                          count, elapsed,
+                                          'OK' if not errors else 'FAILED'))
+    for error in errors[:10]:
+        print('    %s' % error)
+    return not errors
+#---
+
+
+def bench_log(count=200):
+    """ Cost of Shrec.log() below and above the log level threshold """
+    import shrec  # pylint: disable=import-outside-toplevel
+    runner = shrec.Runner()
+    runner.log_level = 'info'
+    disabled = measure('Shrec.log debug, level info', count * 100,
+                       lambda idx: runner.log('message', 'debug'))
+    enabled = measure('Shrec.log info, level info', count,
+                      lambda idx: runner.log('message'))
+    print("%-40s %8.1fx" % ('disabled call is cheaper by', enabled / disabled))
+#---
+
+
+def bench_search(count=200):
+    """ Line search on a synthetic log of count * 50000 lines (10M lines
+        with the default --count): re.findall per line against PatternSet
+    """
+    import re  # pylint: disable=import-outside-toplevel
+    levels = ['INFO', 'INFO', 'INFO', 'DEBUG', 'WARN', 'ERROR']
+    pool = ['2020-02-02 12:%02d:%02d %s worker-%d request %d %s in %dms' %
+            (idx // 60 % 60, idx % 60, levels[idx % len(levels)], idx % 16, idx,
+             'timeout' if idx % 97 == 0 else 'done', idx % 1000)
+            for idx in range(1000)]
+    lines = pool * (count * 50)
+    patterns = ['ERROR', r'ERROR .* timeout', r'worker-1[0-5] ', r'in 99\dms', 'WARN']
+
+    def __findall(pattern):
+        return [idx for (idx, line) in enumerate(lines) if re.findall(pattern, line)]
+
+    print('%d lines' % len(lines))
+    for pattern in patterns[:3]:
+        old = measure('re.findall loop: %s' % pattern, 1, lambda idx, p=pattern: __findall(p))
+        new = measure('TextEditor.find: %s' % pattern, 1,
+                      lambda idx, p=pattern: shellbox.TextEditor.find(lines, p))
+        print("%-40s %8.1fx" % ('speedup', old / new))
+    rare = ['request %d%d ' % (idx, idx) for idx in range(1, 25)] + \
+        [r'worker-%d request \d+ timeout' % idx for idx in range(8)]
+    for pattern_set in (patterns, rare):
+        old = measure('re.findall loop, %d patterns' % len(pattern_set), 1,
+                      lambda idx, s=pattern_set: [__findall(p) for p in s])
+        new = measure('TextEditor.find_many, %d patterns' % len(pattern_set), 1,
+                      lambda idx, s=pattern_set: shellbox.TextEditor.find_many(lines, s))
+        print("%-40s %8.1fx" % ('speedup', old / new))
+#---
+
+
+BENCHMARKS = {
+    'log': bench_log,
+    'search': bench_search,
+    'session': bench_session,
+    'spawn': bench_spawn,
+    'threads': bench_threads,
+}
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="shellbox micro-benchmarks")
+    parser.add_argument("bench", action="store", choices=sorted(BENCHMARKS.keys()) + ['all'],
+                        help="Benchmark to run")
+    parser.add_argument("--count", action="store", type=int, default=None,
+                        help="Iterations per measurement, default of the benchmark")
+    args = parser.parse_args()
+
+    failed = False
+    for name in sorted(BENCHMARKS.keys()):
+        if args.bench in (name, 'all'):
+            # Benchmarks with checks return False when a check fails
+            counts = () if args.count is None else (args.count,)
+            if BENCHMARKS[name](*counts) is False:
+                failed = True
+    sys.exit(1 if failed else 0)
+#---